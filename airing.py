@@ -1,42 +1,34 @@
 import asyncio
-import json
+import heapq
 import string
+import time
 from datetime import datetime, timedelta, timezone
-from collections import namedtuple
+from operator import attrgetter
+from collections import OrderedDict, namedtuple
 
 import aiohttp
-from discord import Embed, MessageType
+from discord import Embed, HTTPException, MessageType
 
-from ...common import Obj
 from ... import module as mod
+from . import sessions
+from .confwriter import ConfigWriter
+from .decoders import decode_airing_page, decode_anilist_response, decode_media_page
+from .ratelimit import TokenBucket
 
 
 log = mod.get_logger()
 
 
+# Airing times change between polls, the shows themselves pretty much don't, so they're fetched separately and cached
 get_airing_query = '''
 query ($show_ids: [Int], $from_t: Int, $to_t: Int, $page: Int) {
   Page(page: $page, perPage: 50) {
     pageInfo {
       hasNextPage
+      lastPage
     }
     airingSchedules(mediaId_in: $show_ids, airingAt_greater: $from_t, airingAt_lesser: $to_t, sort: TIME) {
-      media {
-        id
-        title {
-          english
-          romaji
-        }
-        siteUrl
-        externalLinks {
-          site
-          url
-        }
-        coverImage {
-          medium
-          color
-        }
-      }
+      mediaId
       episode
       airingAt
     }
@@ -44,9 +36,67 @@ query ($show_ids: [Int], $from_t: Int, $to_t: Int, $page: Int) {
 }
 '''
 
+get_media_query = '''
+query ($media_ids: [Int]) {
+  Page(perPage: 50) {
+    media(id_in: $media_ids) {
+      id
+      title {
+        english
+        romaji
+      }
+      siteUrl
+      externalLinks {
+        site
+        url
+      }
+      coverImage {
+        medium
+      }
+    }
+  }
+}
+'''
+
+
+ANILIST_URL = 'https://graphql.anilist.co'
+
+
+class AniListError(Exception): pass
+
 
 Episode = namedtuple('Episode', 'anilist_id title info_url image links number time')
 AnnouncementAction = namedtuple('AnnouncementAction', 'channel_id rename_pattern')
+Media = namedtuple('Media', 'title info_url image links fetched_at')
+
+
+class MediaCache:
+    # LRU with a TTL, on top of the dict that gets saved in the config
+
+    def __init__(self, entries, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict(sorted(entries.items(), key=lambda item: item[1].fetched_at))
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, anilist_id):
+        media = self.entries.get(anilist_id)
+
+        if media is None or time.time() - media.fetched_at > self.ttl:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(anilist_id)
+        return media
+
+    def put(self, anilist_id, media):
+        self.entries[anilist_id] = media
+        self.entries.move_to_end(anilist_id)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
 
 
 class CustomFormatter(string.Formatter):
@@ -65,23 +115,233 @@ class CustomFormatter(string.Formatter):
 fmt = CustomFormatter()
 
 
+def compile_pattern(pattern):
+    # Turns a rename pattern into a function of its keyword arguments, doing all the parsing up front.
+    # Anything fancier than plain attribute lookups with format specs and offsets falls back to fmt.format.
+    parts = []
+
+    for literal, field_name, format_spec, conversion in fmt.parse(pattern):
+        if literal:
+            parts.append(literal)
+
+        if field_name is None:
+            continue
+
+        root, *attrs = field_name.split('.')
+
+        if conversion or not root.isidentifier() or '[' in field_name or '{' in format_spec:
+            return lambda **kwargs: fmt.format(pattern, **kwargs)
+
+        offset = 0
+        while format_spec.startswith('offset'):
+            if (o := format_spec.find(':')) != -1:
+                offset += int(format_spec[6:o])
+                format_spec = format_spec[o+1:]
+            else:
+                offset += int(format_spec[6:])
+                format_spec = ''
+
+        parts.append((root, attrgetter('.'.join(attrs)) if attrs else None, offset, format_spec))
+
+    def render(**kwargs):
+        out = []
+
+        for part in parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+
+            root, getter, offset, format_spec = part
+            value = kwargs[root]
+            if getter is not None:
+                value = getter(value)
+            if offset:
+                value += offset
+
+            out.append(format(value, format_spec))
+
+        return ''.join(out)
+
+    return render
+
+
+class RenameQueue:
+    # Discord only allows a couple of channel renames per 10 minutes, so a rename can sit in a rate limit for a long time.
+    # Each channel gets at most one rename in flight, and only the newest requested name is applied after it.
+
+    def __init__(self):
+        self.pending = {}
+        self.tasks = {}
+        self.coalesced = 0
+
+    def request(self, channel, name):
+        if channel.id in self.pending:
+            self.coalesced += 1
+
+        self.pending[channel.id] = name
+
+        if channel.id not in self.tasks:
+            self.tasks[channel.id] = asyncio.create_task(self._rename(channel))
+
+    async def _rename(self, channel):
+        try:
+            while channel.id in self.pending:
+                name = self.pending.pop(channel.id)
+
+                if channel.name == name:
+                    continue
+
+                try:
+                    await channel.edit(name=name)
+                except HTTPException:
+                    log.exception(f'Failed to rename #{channel} to {name}')
+
+        finally:
+            del self.tasks[channel.id]
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+
+class AnnouncementQueue:
+    # Pending announcements in a min-heap ordered by air time, one entry per (anilist_id, episode).
+    # Cancelled or rescheduled entries stay in the heap and are skipped once they reach the top.
+
+    def __init__(self, episodes=()):
+        self._heap = []
+        self.episodes = {}
+        self._changed = asyncio.Event()
+
+        for ep in episodes:
+            self.add(ep)
+
+    def __len__(self):
+        return len(self.episodes)
+
+    def add(self, ep):
+        key = ep.anilist_id, ep.number
+        current = self.episodes.get(key)
+        self.episodes[key] = ep
+
+        if current is not None and current.time == ep.time:
+            return False
+
+        heapq.heappush(self._heap, (ep.time, key))
+        self._changed.set()
+        return True
+
+    def cancel(self, anilist_id, number):
+        return self.episodes.pop((anilist_id, number), None) is not None
+
+    def peek(self):
+        heap = self._heap
+
+        while heap:
+            at, key = heap[0]
+            ep = self.episodes.get(key)
+
+            if ep is not None and ep.time == at:
+                return ep
+
+            heapq.heappop(heap)
+
+        return None
+
+    def upcoming(self, count):
+        return heapq.nsmallest(count, self.episodes.values(), key=lambda ep: ep.time)
+
+    async def next_due(self):
+        while True:
+            self._changed.clear()
+            ep = self.peek()
+
+            if ep is None:
+                await self._changed.wait()
+                continue
+
+            delay = (ep.time - datetime.now(timezone.utc)).total_seconds()
+
+            if delay <= 0:
+                heapq.heappop(self._heap)
+                del self.episodes[ep.anilist_id, ep.number]
+                return ep
+
+            # Something earlier might get added while we wait
+            try:
+                await asyncio.wait_for(self._changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
 class AiringModule(mod.Module):
     class Config(mod.Config):
         blacklisted_sites: set[str] = {'Official Site', 'Twitter'}
         shows: dict[int, AnnouncementAction] = {}
         refresh_interval: timedelta = timedelta(minutes=5)
         last_check: datetime = datetime.now(timezone.utc)
+        anilist_url: str = ANILIST_URL
+        # Large watch lists are split into chunks of this many shows, fetched side by side
+        anilist_chunk_size: int = 50
+        anilist_concurrency: int = 4
+        # AniList allows 90 per minute, leave some room
+        anilist_requests_per_minute: int = 60
+        media_cache: dict[int, Media] = {}
+        media_cache_ttl: timedelta = timedelta(days=1)
+        media_cache_size: int = 500
+        pending_episodes: dict[tuple[int, int], Episode] = {}
+        # Highest episode number announced per show, so nothing goes out twice
+        announced: dict[int, int] = {}
+        # Long gaps after downtime are fetched as several windows of at most this size
+        backfill_window: timedelta = timedelta(hours=12)
+        # When several episodes of a show were missed, only announce the latest one
+        collapse_missed_episodes: bool = True
+        # Minimum time between two announcements going out
+        announce_spacing: timedelta = timedelta(seconds=2)
+        # How many channels an episode is announced to at the same time
+        announce_concurrency: int = 5
     
     async def on_load(self):
-        self.session = aiohttp.ClientSession()
-        log.info('Session opened')
+        self.session = sessions.shared.acquire()
+        self.conf_writer = ConfigWriter(self.conf)
+
+        self.request_slots = asyncio.Semaphore(self.conf.anilist_concurrency)
+        self.request_budget = TokenBucket(self.conf.anilist_requests_per_minute, 60)
+
+        self.media_cache = MediaCache(self.conf.media_cache, self.conf.media_cache_ttl.total_seconds(), self.conf.media_cache_size)
+
+        # Whatever was still pending before a restart, no need to ask AniList again.
+        # Shows taken out of the config in the meantime aren't announced anymore.
+        pending = [ep for ep in self.conf.pending_episodes.values() if ep.anilist_id in self.conf.shows]
+        if len(pending) < len(self.conf.pending_episodes):
+            log.info(f'Dropping {len(self.conf.pending_episodes) - len(pending)} pending episodes of shows no longer configured')
+            self.conf.pending_episodes = {(ep.anilist_id, ep.number): ep for ep in pending}
+            self.conf_writer.changed()
+
+        self.announcements = AnnouncementQueue(pending)
+        self.announce_tasks = set()
+        self.announce_slots = asyncio.Semaphore(self.conf.announce_concurrency)
+        self.announce_stats = {'sent': 0, 'failed': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+
+        self.renames = RenameQueue()
+        self.rename_patterns = {}
+
+        for actions in self.conf.shows.values():
+            for action in (actions, ) if isinstance(actions, AnnouncementAction) else actions:
+                try:
+                    self.compiled_pattern(action.rename_pattern)
+                except ValueError:
+                    log.error(f'Invalid rename pattern {action.rename_pattern!r} for channel {action.channel_id}', exc_info=True)
+        self.dispatch_task = asyncio.create_task(self.dispatch_announcements())
 
         self.schedule_repeated(self.schedule_episode_announcements, every_delta=self.conf.refresh_interval)
 
     async def on_unload(self):
-        if self.session:
-            log.info('Closing session...')
-            await self.session.close()
+        self.dispatch_task.cancel()
+        self.renames.cancel()
+
+        await self.conf_writer.close()
+        await sessions.shared.release()
 
     async def schedule_episode_announcements(self):
         backoff = mod.ExponentialBackoff()
@@ -89,103 +349,349 @@ class AiringModule(mod.Module):
 
         while True:
             try:
-                to_t = datetime.now(timezone.utc) + self.conf.refresh_interval
-                episodes = await self.fetch_upcoming_episodes(from_t, to_t)
+                now = datetime.now(timezone.utc)
+                to_t = now + self.conf.refresh_interval
+                episodes = await self.fetch_episodes_between(from_t, to_t)
                 break
 
-            except (OSError, aiohttp.ClientError, asyncio.TimeoutError):
+            except (OSError, aiohttp.ClientError, asyncio.TimeoutError, AniListError):
                 log.info('Episode request failed, retrying...', exc_info=True)
                 await asyncio.sleep(backoff.delay())
 
+        episodes = [ep for ep in episodes if ep.number > self.conf.announced.get(ep.anilist_id, 0)]
+
+        if self.conf.collapse_missed_episodes:
+            episodes = self.collapse_missed(episodes, now)
+
         for ep in episodes:
-            self.schedule_task(self.announce_episode(ep), at_datetime=ep.time)
+            self.announcements.add(ep)
         
         self.conf.last_check = to_t
-        await self.conf.commit()
+        self.conf.media_cache = dict(self.media_cache.entries)
+        self.conf.pending_episodes = dict(self.announcements.episodes)
+        self.conf_writer.changed()
+
+    async def fetch_episodes_between(self, from_t, to_t):
+        # After downtime the gap can be days long, which is better fetched as several smaller windows at once
+        window = self.conf.backfill_window
+        windows = []
+
+        while from_t < to_t:
+            windows.append((from_t, min(from_t + window, to_t)))
+            from_t += window
+
+        if len(windows) > 1:
+            log.info(f'Catching up on {len(windows)} windows since {windows[0][0]}')
+
+        results = await asyncio.gather(*(self.fetch_upcoming_episodes(start, end) for start, end in windows))
+
+        # Windows overlap by a second at the edges
+        episodes = {(ep.anilist_id, ep.number): ep for result in results for ep in result}
+        return sorted(episodes.values(), key=lambda ep: ep.time)
+
+    def collapse_missed(self, episodes, now):
+        # Of the episodes that already aired, including ones still waiting in the queue, keep only the latest per show
+        latest = {}
+
+        for ep in [*self.announcements.episodes.values(), *episodes]:
+            if ep.time <= now and (ep.anilist_id not in latest or ep.number > latest[ep.anilist_id].number):
+                latest[ep.anilist_id] = ep
+
+        skipped = 0
+
+        for ep in list(self.announcements.episodes.values()):
+            if ep.time <= now and ep.number < latest[ep.anilist_id].number:
+                self.announcements.cancel(ep.anilist_id, ep.number)
+                skipped += 1
+
+        kept = []
+
+        for ep in episodes:
+            if ep.time <= now and ep.number < latest[ep.anilist_id].number:
+                skipped += 1
+            else:
+                kept.append(ep)
+
+        if skipped:
+            log.info(f'Skipping {skipped} missed episodes that have newer ones')
+
+        return kept
+
+    async def dispatch_announcements(self):
+        last_start = 0
+
+        while True:
+            ep = await self.announcements.next_due()
+
+            # Keep a burst of overdue announcements from all going out at the same moment
+            wait = last_start + self.conf.announce_spacing.total_seconds() - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            last_start = time.monotonic()
+
+            if ep.number <= self.conf.announced.get(ep.anilist_id, 0):
+                log.info(f'{ep.title}#{ep.number} was already announced, skipping')
+                continue
+
+            # Recorded before announcing, a crash halfway through shouldn't lead to a second announcement
+            self.conf.announced[ep.anilist_id] = ep.number
+            self.conf.pending_episodes = dict(self.announcements.episodes)
+            self.conf_writer.changed()
+
+            backoff = mod.ExponentialBackoff()
+            while True:
+                try:
+                    await self.conf_writer.flush(forced=True)
+                    break
+
+                except Exception:
+                    delay = backoff.delay()
+                    log.exception(f'Could not record {ep.title}#{ep.number} as announced, retrying in {delay:.1f}s')
+                    await asyncio.sleep(delay)
+
+            # Announcing can take a while, it shouldn't hold up the next one
+            task = asyncio.create_task(self.announce_episode(ep))
+            self.announce_tasks.add(task)
+            task.add_done_callback(self._announce_done)
+
+    def _announce_done(self, task):
+        self.announce_tasks.discard(task)
+
+        if not task.cancelled() and task.exception() is not None:
+            log.error('Announcement failed', exc_info=task.exception())
+
+    async def query_anilist(self, query, variables, decode):
+        async with self.request_slots:
+            while True:
+                while not self.request_budget.try_take():
+                    await asyncio.sleep(self.request_budget.delay())
+
+                async with self.session.post(self.conf.anilist_url, json={
+                    'query': query,
+                    'variables': variables,
+                }, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    if response.status == 429:
+                        retry_after = int(response.headers.get('Retry-After', 60))
+                        log.warning(f'AniList rate limit hit, waiting {retry_after}s')
+                        await asyncio.sleep(retry_after)
+                        continue
+
+                    data, errors = decode_anilist_response(await response.read())
+
+                if data is None or errors:
+                    log.error(f'AniList query failed! {errors}')
+                    raise AniListError(errors)
+
+                return decode(data)
+
+    async def fetch_airing_page(self, show_ids, from_t, to_t, page_number):
+        data = await self.query_anilist(get_airing_query, {
+            'show_ids': show_ids,
+            'from_t': int(datetime.timestamp(from_t)),
+            'to_t': int(datetime.timestamp(to_t)) + 1,
+            'page': page_number,
+        }, decode_airing_page)
+
+        log.debug(data)
+        return data
+
+    async def fetch_airing_schedules(self, show_ids, from_t, to_t):
+        first_page = await self.fetch_airing_page(show_ids, from_t, to_t, 1)
+        pages = [first_page]
+
+        if first_page.has_next_page:
+            # Once we know how many pages there are, get the rest all at once
+            last_page = max(2, first_page.last_page or 2)
+            pages += await asyncio.gather(*(
+                self.fetch_airing_page(show_ids, from_t, to_t, page_number)
+                for page_number in range(2, last_page + 1)
+            ))
+
+            # lastPage is only an estimate, in case more turned up in the meantime
+            while pages[-1].has_next_page:
+                last_page += 1
+                pages.append(await self.fetch_airing_page(show_ids, from_t, to_t, last_page))
+
+        return [episode_data for page in pages for episode_data in page.schedules]
+
+    async def fetch_media(self, media_ids):
+        found = {media_id: self.media_cache.get(media_id) for media_id in media_ids}
+        missing = [media_id for media_id, media in found.items() if media is None]
+
+        if missing:
+            log.debug(f'Fetching metadata for {len(missing)} shows...')
+
+            pages = await asyncio.gather(*(
+                self.query_anilist(get_media_query, {'media_ids': missing[i:i + 50]}, decode_media_page)
+                for i in range(0, len(missing), 50)
+            ))
+
+            now = time.time()
+
+            for page in pages:
+                for media in page:
+                    found[media.id] = Media(
+                        title=media.title,
+                        info_url=media.info_url,
+                        image=media.image,
+                        links=media.links,
+                        fetched_at=now,
+                    )
+
+                    self.media_cache.put(media.id, found[media.id])
+
+        return found
 
     async def fetch_upcoming_episodes(self, from_t, to_t):
         if len(self.conf.shows) == 0:
             return []
 
-        episodes = []
-        page_number = 0
+        log.debug(f'Fetching episodes from {from_t} to {to_t}...')
 
-        while True:
-            log.debug(f'Fetching episodes from {from_t} to {to_t}...')
-
-            async with self.session.post('https://graphql.anilist.co', json={
-                'query': get_airing_query,
-                'variables': {
-                  'show_ids': list(self.conf.shows),
-                  'from_t': int(datetime.timestamp(from_t)),
-                  'to_t': int(datetime.timestamp(to_t)) + 1,
-                  'page': page_number
-                }
-            }, timeout=aiohttp.ClientTimeout(total=10)) as response:
-                resp = json.loads(await response.text(), object_hook=Obj)
-
-                if (
-                    'data' not in resp or resp.data is None
-                    or 'errors' in resp and resp.errors not in (None, [])
-                ):
-                    log.error(f'Failed to reload episodes! {resp}')
-
-                data = resp.data.Page
-            
-            log.debug(data)
-
-            for episode_data in data.airingSchedules:
-                media = episode_data.media
-                ep = Episode(
-                    anilist_id=media.id,
-                    title=media.title.english or media.title.romaji,
-                    info_url=media.siteUrl,
-                    image=media.coverImage.medium,
-                    links=[(link.site, link.url) for link in media.externalLinks if link.site not in self.conf.blacklisted_sites],
-                    number=episode_data.episode,
-                    time=datetime.fromtimestamp(episode_data.airingAt, timezone.utc),
-                )
-
-                episodes.append(ep)
-
-            if not data.pageInfo.hasNextPage:
-                break
-            
-            page_number += 1
+        show_ids = list(self.conf.shows)
+        chunk_size = self.conf.anilist_chunk_size
+        chunks = [show_ids[i:i + chunk_size] for i in range(0, len(show_ids), chunk_size)]
 
-        return episodes
+        results = await asyncio.gather(*(self.fetch_airing_schedules(chunk, from_t, to_t) for chunk in chunks))
+        schedules = [episode_data for result in results for episode_data in result]
+
+        media = await self.fetch_media([episode_data.media_id for episode_data in schedules])
+        episodes = {}
+
+        for episode_data in schedules:
+            show = media[episode_data.media_id]
+            if show is None:
+                log.error(f'No metadata for show {episode_data.media_id}, skipping episode {episode_data.episode}')
+                continue
+
+            ep = Episode(
+                anilist_id=episode_data.media_id,
+                title=show.title,
+                info_url=show.info_url,
+                image=show.image,
+                links=[(site, url) for site, url in show.links if site not in self.conf.blacklisted_sites],
+                number=episode_data.episode,
+                time=datetime.fromtimestamp(episode_data.airing_at, timezone.utc),
+            )
+
+            # Pages can shift while we're reading them, so the same episode may show up twice
+            episodes[ep.anilist_id, ep.number] = ep
+
+        return sorted(episodes.values(), key=lambda ep: ep.time)
+
+    def compiled_pattern(self, pattern):
+        if pattern is None:
+            return None
+
+        if pattern not in self.rename_patterns:
+            try:
+                self.rename_patterns[pattern] = compile_pattern(pattern)
+            except ValueError:
+                # Remembered as unusable, so it's only reported once and renames with it are skipped
+                self.rename_patterns[pattern] = None
+                raise
+
+        return self.rename_patterns[pattern]
+
+    def build_announcement(self, ep):
+        links = ' '.join(f'[[{name}]]({url})' for name, url in ep.links)
+
+        embed = Embed(
+            title=f'New {ep.title} Episode',
+            url=ep.info_url,
+            description=f'**{ep.title}** Episode **{ep.number}** just aired!\n\n{links}',
+            timestamp=ep.time,
+        )
+
+        embed.set_thumbnail(url=ep.image)
+        return embed
 
     async def announce_episode(self, ep):
         actions = self.conf.shows.get(ep.anilist_id)
 
+        if actions is None:
+            log.info(f'{ep.title}#{ep.number} is no longer configured, not announcing it')
+            return
+
         if isinstance(actions, AnnouncementAction):
             actions = (actions, )
 
         log.info(f'Announcing {ep.title}#{ep.number}...')
 
-        for action in actions:
-            channel = self.bot.get_channel(action.channel_id)
-            if channel is None:
-                log.error(f'Announcement for {ep.title}#{ep.number} dropped, invalid channel {action.channel_id}')
-                return
-        
-            links = ' '.join(f'[[{name}]]({url})' for name, url in ep.links)
-
-            embed = Embed(
-                title=f'New {ep.title} Episode',
-                colour=channel.guild.me.color,
-                url=ep.info_url,
-                description=f'**{ep.title}** Episode **{ep.number}** just aired!\n\n{links}',
-                timestamp=ep.time,
-            )
+        base_embed = self.build_announcement(ep)
+        guild_embeds = {}
+
+        def embed_for(channel):
+            # Same embed everywhere, only the colour follows the bot's role colour in each guild
+            if channel.guild.id not in guild_embeds:
+                embed = guild_embeds[channel.guild.id] = base_embed.copy()
+                embed.colour = channel.guild.me.color
+
+            return guild_embeds[channel.guild.id]
+
+        # Channels are announced to side by side, each one still goes send -> pin -> rename in order
+        results = await asyncio.gather(*(self.announce_to_channel(ep, action, embed_for) for action in actions))
+
+        failed = [action.channel_id for action, ok in zip(actions, results) if not ok]
+        if failed:
+            log.error(f'Announcement for {ep.title}#{ep.number} failed in {len(failed)} of {len(actions)} channels: {failed}')
+
+    async def announce_to_channel(self, ep, action, embed_for):
+        channel = self.bot.get_channel(action.channel_id)
+        if channel is None:
+            log.error(f'Announcement for {ep.title}#{ep.number} dropped, invalid channel {action.channel_id}')
+            self.announce_stats['failed'] += 1
+            return False
+
+        start = time.monotonic()
+
+        # discord.py already waits out per-route buckets, this keeps us from queueing up too many requests at once
+        async with self.announce_slots:
+            try:
+                message = await channel.send(embed=embed_for(channel))
+                await message.pin()
+
+            except HTTPException:
+                log.exception(f'Announcement for {ep.title}#{ep.number} failed in #{channel}')
+                self.announce_stats['failed'] += 1
+                return False
+
+        # Queued, a rename stuck in the rate limit shouldn't hold up the announcement.
+        # A broken pattern only costs the rename, the announcement is already out.
+        if action.rename_pattern is not None:
+            try:
+                render = self.compiled_pattern(action.rename_pattern)
+                if render is not None:
+                    self.renames.request(channel, render(ep=ep))
+
+            except (ValueError, AttributeError, KeyError, IndexError, TypeError):
+                log.exception(f'Rename pattern {action.rename_pattern!r} failed for {ep.title}#{ep.number} in #{channel}')
+
+        latency = time.monotonic() - start
+        self.announce_stats['sent'] += 1
+        self.announce_stats['latency_total'] += latency
+        self.announce_stats['latency_max'] = max(self.announce_stats['latency_max'], latency)
+
+        log.info(f'Announced {ep.title}#{ep.number} in #{channel} after {latency:.2f}s')
+        return True
+
+    @mod.group(name='airing', invoke_without_command=True)
+    @mod.is_owner()
+    async def airing_cmd(self, ctx, count: int = 10):
+        stats = self.announce_stats
+        average = stats['latency_total'] / stats['sent'] if stats['sent'] else 0
+        summary = f'{stats["sent"]} channel announcements sent, {stats["failed"]} failed, {average:.2f}s average, {stats["latency_max"]:.2f}s max\n'
+        summary += self.conf_writer.summary() + '\n'
 
-            embed.set_thumbnail(url=ep.image)
+        upcoming = self.announcements.upcoming(count)
 
-            message = await channel.send(embed=embed)
-            await message.pin()
+        if not upcoming:
+            await ctx.send(summary + 'No announcements pending.')
+            return
 
-            if action.rename_pattern is not None:
-                await channel.edit(name=fmt.format(action.rename_pattern, ep=ep))
+        lines = (f' - {ep.time:%Y-%m-%d %H:%M} UTC: **{ep.title}** #{ep.number}' for ep in upcoming)
+        await ctx.send_paginated(summary + f'Next {len(upcoming)} of {len(self.announcements)} pending announcements:\n' + '\n'.join(lines))
 
     # Delete any "X pinned a message to this channel" messages that happen from the bot pinning its own messages
     @mod.Module.listener()
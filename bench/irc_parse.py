@@ -0,0 +1,124 @@
+# Microbenchmark for the Twitch IRC parsers
+# Usage: python bench/irc_parse.py [recorded_lines.txt] [-n ROUNDS]
+#
+# Without a recording, a built-in sample of captured chat traffic is used.
+# Recordings are one raw IRC line per line, exactly as they came off the socket.
+
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+from modules import load
+
+twitch, = load('twitch')
+
+
+SAMPLE_LINES = [
+    '@badge-info=subscriber/14;badges=subscriber/12,premium/1;client-nonce=4f7c1e0a9b3d2e6f8a1c5b7d9e0f2a4c;color=#FF4500;display-name=SomeViewer;emotes=;first-msg=0;flags=;id=b34ccfc7-4977-403a-8a94-33c6bac34fb8;mod=0;returning-chatter=0;room-id=123456789;subscriber=1;tmi-sent-ts=1642696567751;turbo=0;user-id=987654321;user-type= :someviewer!someviewer@someviewer.tmi.twitch.tv PRIVMSG #nearlyonred :that was a clean run',
+    '@badge-info=;badges=moderator/1;color=#1E90FF;display-name=ModPerson;emotes=25:0-4,12-16/1902:6-10;first-msg=0;flags=;id=e9176cd8-5e22-4684-ad40-ce53c2561c5e;mod=1;room-id=123456789;subscriber=0;tmi-sent-ts=1642696568210;turbo=0;user-id=11223344;user-type=mod :modperson!modperson@modperson.tmi.twitch.tv PRIVMSG #nearlyonred :Kappa Keepo Kappa',
+    '@badge-info=;badges=;color=;display-name=lurker_42;emotes=;first-msg=1;flags=;id=3e1a6a3d-7c0b-4a57-9d3f-5fb0e1e3e0b1;mod=0;room-id=123456789;subscriber=0;tmi-sent-ts=1642696569001;turbo=0;user-id=55667788;user-type= :lurker_42!lurker_42@lurker_42.tmi.twitch.tv PRIVMSG #nearlyonred :hello chat; first time here :)',
+    '@badge-info=subscriber/3;badges=subscriber/3;color=#8A2BE2;display-name=Escaper;emotes=;flags=;id=7a1c3b5e-9d2f-4e6a-8b0c-1d3e5f7a9b2c;login=escaper;mod=0;msg-id=resub;msg-param-cumulative-months=3;msg-param-should-share-streak=0;msg-param-sub-plan-name=Channel\\sSubscription\\s(nearlyonred);msg-param-sub-plan=1000;room-id=123456789;subscriber=1;system-msg=Escaper\\ssubscribed\\sat\\sTier\\s1.\\sThey\\shave\\ssubscribed\\sfor\\s3\\smonths!;tmi-sent-ts=1642696570123;user-id=99887766;user-type= :tmi.twitch.tv USERNOTICE #nearlyonred :three months already',
+    '@emote-only=0;followers-only=-1;r9k=0;room-id=123456789;slow=0;subs-only=0 :tmi.twitch.tv ROOMSTATE #nearlyonred',
+    '@badge-info=;badges=;color=;display-name=nearlyontime;emote-sets=0,300374282;mod=0;subscriber=0;user-type= :tmi.twitch.tv USERSTATE #nearlyonred',
+    '@login=spammer;room-id=;target-msg-id=b34ccfc7-4977-403a-8a94-33c6bac34fb8;tmi-sent-ts=1642696571000 :tmi.twitch.tv CLEARMSG #nearlyonred :buy followers at',
+    ':nearlyontime!nearlyontime@nearlyontime.tmi.twitch.tv JOIN #nearlyonred',
+    ':nearlyontime.tmi.twitch.tv 353 nearlyontime = #nearlyonred :nearlyontime',
+    ':nearlyontime.tmi.twitch.tv 366 nearlyontime #nearlyonred :End of /NAMES list',
+    ':tmi.twitch.tv 001 nearlyontime :Welcome, GLHF!',
+    ':tmi.twitch.tv CAP * ACK :twitch.tv/tags',
+]
+
+
+def read_command(msg):
+    return msg.command
+
+def read_logger_fields(msg):
+    # Mirrors what report.MessageLogger looks at
+    if msg.command == 'PRIVMSG':
+        return msg.tags['id'], msg.name, msg.params[1], msg.tags['tmi-sent-ts']
+
+def read_everything(msg):
+    return dict(msg.tags), msg.name, msg.nick, msg.host, msg.command, msg.params
+
+
+def measure_speed(parse, access, lines, rounds):
+    gc.collect()
+    start = time.perf_counter()
+
+    for _ in range(rounds):
+        for line in lines:
+            access(parse(line))
+
+    elapsed = time.perf_counter() - start
+    return len(lines) * rounds / elapsed
+
+
+def measure_allocations(parse, access, lines):
+    # Blocks and bytes still alive per parsed line, plus tracemalloc's peak for the whole batch
+    gc.collect()
+    tracemalloc.start()
+    before_blocks = sys.getallocatedblocks()
+    before_bytes, _ = tracemalloc.get_traced_memory()
+
+    kept = []
+    for line in lines:
+        msg = parse(line)
+        access(msg)
+        kept.append(msg)
+
+    after_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    after_blocks = sys.getallocatedblocks()
+    tracemalloc.stop()
+
+    n = len(lines)
+    del kept
+    return (after_blocks - before_blocks) / n, (after_bytes - before_bytes) / n, (peak_bytes - before_bytes) / n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recording', nargs='?')
+    parser.add_argument('-n', '--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.recording:
+        with open(args.recording, encoding='utf-8') as f:
+            lines = [line.rstrip('\r\n') for line in f if line.strip()]
+    else:
+        lines = SAMPLE_LINES
+
+    tagged = [line for line in lines if line.startswith('@')]
+    untagged = [line for line in lines if not line.startswith('@')]
+    rounds = max(1, args.rounds * len(SAMPLE_LINES) // len(lines))
+
+    parsers = [
+        ('eager', twitch.parse_irc_message),
+        ('lazy', twitch.parse_irc_message_lazy),
+    ]
+
+    accesses = [
+        ('command only', read_command),
+        ('logger fields', read_logger_fields),
+        ('everything', read_everything),
+    ]
+
+    print(f'{len(lines)} lines ({len(tagged)} tagged, {len(untagged)} untagged), {rounds} rounds\n')
+    print(f'{"set":<10} {"access":<14} {"parser":<6} {"lines/s":>12} {"blocks/line":>12} {"bytes/line":>11} {"peak/line":>10}')
+
+    for set_name, set_lines in (('all', lines), ('tagged', tagged), ('untagged', untagged)):
+        if not set_lines:
+            continue
+
+        for access_name, access in accesses:
+            for parser_name, parse in parsers:
+                speed = measure_speed(parse, access, set_lines, rounds)
+                blocks, size, peak = measure_allocations(parse, access, set_lines * 100)
+                print(f'{set_name:<10} {access_name:<14} {parser_name:<6} {speed:>12,.0f} {blocks:>12.1f} {size:>11.0f} {peak:>10.0f}')
+
+        print()
+
+
+if __name__ == '__main__':
+    main()
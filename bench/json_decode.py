@@ -0,0 +1,151 @@
+# Compares the schema-specific decoders with the json.loads(..., object_hook=Obj) they replaced
+# Usage: python bench/json_decode.py [-n ROUNDS]
+#
+# Covers an AniList airing page, a whisper as it comes off PubSub (envelope and all), and a message
+# on a topic nobody decodes. When orjson is installed the decoders are run with both backends.
+
+import argparse
+import gc
+import json
+import time
+
+from gs6ex.common import Obj
+
+from modules import load
+
+decoders, twitch = load('decoders', 'twitch')
+
+
+def make_airing_page(count=50):
+    return json.dumps({'data': {'Page': {
+        'pageInfo': {'hasNextPage': True, 'lastPage': 3},
+        'airingSchedules': [
+            {'mediaId': 100000 + i, 'episode': i % 24 + 1, 'airingAt': 1642696567 + i * 1800}
+            for i in range(count)
+        ],
+    }}}).encode()
+
+
+def make_pubsub_message(topic, message):
+    return json.dumps({'type': 'MESSAGE', 'data': {'topic': topic, 'message': json.dumps(message)}})
+
+
+WHISPER = make_pubsub_message('whispers.123456789', {
+    'type': 'whisper_received',
+    'data': json.dumps({
+        'message_id': 'b34ccfc7-4977-403a-8a94-33c6bac34fb8',
+        'id': 4242,
+        'thread_id': '123456789_987654321',
+        'body': 'report e9176cd8-5e22-4684-ad40-ce53c2561c5e spam',
+        'sent_ts': 1642696567,
+        'from_id': 987654321,
+        'tags': {
+            'login': 'someviewer',
+            'display_name': 'SomeViewer',
+            'color': '#FF4500',
+            'emotes': [],
+            'badges': [{'id': 'subscriber', 'version': '12'}],
+        },
+        'recipient': {'id': 123456789, 'username': 'nearlyontime', 'display_name': 'nearlyontime', 'color': ''},
+    }),
+    'data_object': {'id': 4242, 'body': 'report e9176cd8-5e22-4684-ad40-ce53c2561c5e spam'},
+})
+
+THREAD_UPDATE = make_pubsub_message('whispers.123456789', {
+    'type': 'thread',
+    'data': json.dumps({'thread_id': '123456789_987654321', 'last_read': 4242, 'archived': False, 'muted': False}),
+})
+
+UNDECODED_TOPIC = make_pubsub_message('channel-points-channel-v1.123456789', {
+    'type': 'reward-redeemed',
+    'data': {'timestamp': '2022-01-20T16:36:07Z', 'redemption': {'user': {'login': 'someviewer'}, 'reward': {'cost': 500}}},
+})
+
+
+# The old paths, as they were in airing.py, twitch.py and report.py
+
+def old_airing_page(raw):
+    resp = json.loads(raw.decode(), object_hook=Obj)
+    return [(s.mediaId, s.episode, s.airingAt) for s in resp.data.Page.airingSchedules]
+
+def old_pubsub(raw):
+    msg = json.loads(raw, object_hook=Obj)
+    message = json.loads(msg.data.message, object_hook=Obj)
+
+    if message.type == 'whisper_received':
+        data = json.loads(message.data, object_hook=Obj)
+        return data.tags.login, data.body
+
+
+# The new ones
+
+def new_airing_page(raw):
+    data, errors = decoders.decode_anilist_response(raw)
+    return [(s.media_id, s.episode, s.airing_at) for s in decoders.decode_airing_page(data).schedules]
+
+def new_pubsub(raw):
+    envelope = twitch.decode_pubsub_envelope(raw)
+
+    if envelope.topic.partition('.')[0] == 'whispers':
+        whisper = decoders.decode_whisper(envelope.message)
+        if whisper is not None:
+            return whisper.sender, whisper.body
+
+
+def measure(decode, raw, rounds):
+    gc.collect()
+    start = time.perf_counter()
+
+    for _ in range(rounds):
+        decode(raw)
+
+    return rounds / (time.perf_counter() - start)
+
+
+def use_backend(loads):
+    decoders.json_loads = loads
+    twitch.json_loads = loads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--rounds', type=int, default=20000)
+    args = parser.parse_args()
+
+    airing_page = make_airing_page()
+
+    # Sanity check before timing anything
+    assert old_airing_page(airing_page) == new_airing_page(airing_page)
+    for raw in (WHISPER, THREAD_UPDATE, UNDECODED_TOPIC):
+        assert old_pubsub(raw) == new_pubsub(raw)
+
+    cases = [
+        ('airing page (50)', old_airing_page, new_airing_page, airing_page, args.rounds // 10),
+        ('whisper', old_pubsub, new_pubsub, WHISPER, args.rounds),
+        ('thread update', old_pubsub, new_pubsub, THREAD_UPDATE, args.rounds),
+        ('other topic', old_pubsub, new_pubsub, UNDECODED_TOPIC, args.rounds),
+    ]
+
+    backends = [('json', json.loads)]
+    try:
+        import orjson
+        backends.append(('orjson', orjson.loads))
+    except ImportError:
+        print('orjson not installed, only timing the json backend\n')
+
+    print(f'{"payload":<18} {"decoder":<14} {"decoded/s":>12} {"speedup":>8}')
+
+    for name, old, new, raw, rounds in cases:
+        baseline = measure(old, raw, rounds)
+        print(f'{name:<18} {"object_hook":<14} {baseline:>12,.0f} {1:>7.2f}x')
+
+        for backend_name, loads in backends:
+            use_backend(loads)
+            speed = measure(new, raw, rounds)
+            print(f'{name:<18} {"typed/" + backend_name:<14} {speed:>12,.0f} {speed / baseline:>7.2f}x')
+
+        print()
+
+
+if __name__ == '__main__':
+    main()
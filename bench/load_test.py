@@ -0,0 +1,528 @@
+# End-to-end load test against local stand-ins for Twitch IRC, Twitch PubSub and AniList
+# Usage: python bench/load_test.py [--rate LINES_PER_S] [--channels N] [--duration S] [--whisper-rate N] [--shows N]
+#        python bench/load_test.py --serve [--port PORT]
+#
+# The stand-ins run in their own process so they don't eat into the client's CPU time. By default
+# they're driven with the modules' own classes: the report module's MessageLogger and ReportReciever,
+# and AiringModule.fetch_upcoming_episodes with its request budget and media cache. Only what's around
+# them (Discord, the report workers, the module config) is left out. Needs gs6ex importable.
+#
+# With --serve only the stand-ins run. Point a whole bot at them with the report module's
+# twitch_irc_url / twitch_pubsub_url and the airing module's anilist_url.
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+import types
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+from aiohttp import web
+
+from modules import load
+
+airing, metrics, ratelimit, report, sessions = load('airing', 'metrics', 'ratelimit', 'report', 'sessions')
+
+
+# How often the stand-ins send out whatever traffic has accumulated
+TICK = 0.01
+
+
+# Stand-ins
+
+def chat_line(n, channel, sent):
+    # Shaped like real chat, plus x-sent so the client can tell how long the line took to get through
+    user = f'viewer{n % 5000}'
+    return (
+        f'@badge-info=;badges=;color=#FF4500;display-name={user};emotes=;first-msg=0;flags=;'
+        f'id=00000000-0000-4000-8000-{n:012x};mod=0;room-id=123456789;subscriber=0;tmi-sent-ts={int(sent * 1000)};'
+        f'turbo=0;user-id={n % 5000};user-type=;x-sent={sent:.6f} '
+        f':{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #{channel} :message number {n} in the load test'
+    )
+
+
+def whisper_message(topic, n):
+    data = json.dumps({
+        'message_id': f'00000000-0000-4000-9000-{n:012x}',
+        'id': n,
+        'thread_id': f'123456789_{n % 1000}',
+        'body': f'report 00000000-0000-4000-8000-{n:012x} spam',
+        'sent_ts': int(time.time()),
+        'from_id': n % 1000,
+        'tags': {'login': f'viewer{n % 1000}', 'display_name': f'Viewer{n % 1000}', 'color': '', 'emotes': [], 'badges': []},
+        'recipient': {'id': 123456789, 'username': 'nearlyontime', 'display_name': 'nearlyontime', 'color': ''},
+    })
+
+    return json.dumps({
+        'type': 'MESSAGE',
+        'data': {'topic': topic, 'message': json.dumps({'type': 'whisper_received', 'data': data})},
+    })
+
+
+class StandIns:
+    def __init__(self, args):
+        self.rate = args.rate
+        self.whisper_rate = args.whisper_rate
+        self.ping_interval = args.ping_interval
+        self.anilist_latency = args.anilist_latency
+
+        # websocket -> joined channels / LISTENed topics
+        self.irc_clients = {}
+        self.pubsub_clients = {}
+        self.tasks = []
+
+        self.lines_sent = 0
+        self.whispers_sent = 0
+        self.anilist_requests = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/irc', self.irc)
+        app.router.add_get('/pubsub', self.pubsub)
+        app.router.add_post('/graphql', self.anilist)
+        app.router.add_post('/control/drop-irc', self.drop_irc)
+        app.router.add_post('/control/reconnect-pubsub', self.reconnect_pubsub)
+        app.router.add_get('/control/stats', self.stats)
+        app.on_startup.append(self.start)
+        app.on_cleanup.append(self.stop)
+        return app
+
+    async def start(self, app):
+        self.tasks = [
+            asyncio.create_task(self.generate_chat()),
+            asyncio.create_task(self.generate_whispers()),
+            asyncio.create_task(self.ping_irc()),
+        ]
+
+    async def stop(self, app):
+        for task in self.tasks:
+            task.cancel()
+
+    async def _send(self, ws, data):
+        if ws.closed:
+            return False
+
+        try:
+            await ws.send_str(data)
+            return True
+        except ConnectionError:
+            return False
+
+    async def irc(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        channels = self.irc_clients[ws] = set()
+
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+
+                for line in msg.data.split('\r\n'):
+                    command, _, rest = line.partition(' ')
+
+                    if command == 'NICK':
+                        await self._send(ws, f':tmi.twitch.tv 001 {rest} :Welcome, GLHF!\r\n')
+
+                    elif command == 'CAP':
+                        await self._send(ws, f':tmi.twitch.tv CAP * ACK {rest.partition(" ")[2]}\r\n')
+
+                    elif command == 'JOIN':
+                        for channel in rest.split(','):
+                            channels.add(channel.lstrip('#'))
+                            await self._send(ws, f':nearlyontime!nearlyontime@nearlyontime.tmi.twitch.tv JOIN {channel}\r\n')
+
+                    elif command == 'PART':
+                        for channel in rest.split(','):
+                            channels.discard(channel.lstrip('#'))
+
+        finally:
+            del self.irc_clients[ws]
+
+        return ws
+
+    async def generate_chat(self):
+        carry = 0
+        n = 0
+        last = time.monotonic()
+
+        while True:
+            await asyncio.sleep(TICK)
+
+            now = time.monotonic()
+            carry += (now - last) * self.rate
+            last = now
+
+            targets = [(ws, channel) for ws, channels in self.irc_clients.items() for channel in channels]
+            count = int(carry)
+            carry -= count
+
+            if not targets or not count:
+                continue
+
+            # Everything for one connection goes out as one frame, like Twitch does when chat is busy
+            sent = time.time()
+            frames = {}
+            for i in range(n, n + count):
+                ws, channel = targets[i % len(targets)]
+                frames.setdefault(ws, []).append(chat_line(i, channel, sent))
+
+            n += count
+
+            for ws, lines in frames.items():
+                if await self._send(ws, '\r\n'.join(lines) + '\r\n'):
+                    self.lines_sent += len(lines)
+
+    async def ping_irc(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+
+            for ws in list(self.irc_clients):
+                await self._send(ws, 'PING :tmi.twitch.tv\r\n')
+
+    async def pubsub(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        topics = self.pubsub_clients[ws] = set()
+
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+
+                data = json.loads(msg.data)
+
+                if data['type'] == 'PING':
+                    await self._send(ws, json.dumps({'type': 'PONG'}))
+
+                elif data['type'] in ('LISTEN', 'UNLISTEN'):
+                    if data['type'] == 'LISTEN':
+                        topics.update(data['data']['topics'])
+                    else:
+                        topics.difference_update(data['data']['topics'])
+
+                    await self._send(ws, json.dumps({'type': 'RESPONSE', 'nonce': data.get('nonce'), 'error': ''}))
+
+        finally:
+            del self.pubsub_clients[ws]
+
+        return ws
+
+    async def generate_whispers(self):
+        carry = 0
+        n = 0
+        last = time.monotonic()
+
+        while True:
+            await asyncio.sleep(TICK)
+
+            now = time.monotonic()
+            carry += (now - last) * self.whisper_rate
+            last = now
+
+            targets = [(ws, topic) for ws, topics in self.pubsub_clients.items() for topic in topics if topic.startswith('whispers.')]
+            count = int(carry)
+            carry -= count
+
+            if not targets:
+                continue
+
+            for i in range(n, n + count):
+                ws, topic = targets[i % len(targets)]
+                if await self._send(ws, whisper_message(topic, i)):
+                    self.whispers_sent += 1
+
+            n += count
+
+    async def anilist(self, request):
+        body = await request.json()
+        variables = body['variables']
+        self.anilist_requests += 1
+
+        await asyncio.sleep(self.anilist_latency)
+
+        if 'media_ids' in variables:
+            return web.json_response({'data': {'Page': {'media': [{
+                'id': media_id,
+                'title': {'english': None, 'romaji': f'Show {media_id}'},
+                'siteUrl': f'https://anilist.co/anime/{media_id}',
+                'coverImage': {'medium': f'https://example.invalid/{media_id}.png'},
+                'externalLinks': [{'site': 'Crunchyroll', 'url': f'https://example.invalid/watch/{media_id}'}],
+            } for media_id in variables['media_ids'][:50]]}}})
+
+        # Every show airs once a day at its own time of day
+        from_t, to_t = variables['from_t'], variables['to_t']
+        schedules = []
+
+        for media_id in variables['show_ids']:
+            offset = media_id * 7919 % 86400
+
+            for day in range(from_t // 86400, to_t // 86400 + 1):
+                airing_at = day * 86400 + offset
+                if from_t < airing_at < to_t:
+                    schedules.append({'mediaId': media_id, 'episode': day % 24 + 1, 'airingAt': airing_at})
+
+        schedules.sort(key=lambda schedule: schedule['airingAt'])
+
+        page = variables['page']
+        last_page = max(1, -(-len(schedules) // 50))
+
+        return web.json_response({'data': {'Page': {
+            'pageInfo': {'hasNextPage': page < last_page, 'lastPage': last_page},
+            'airingSchedules': schedules[(page - 1) * 50:page * 50],
+        }}})
+
+    async def drop_irc(self, request):
+        for ws in list(self.irc_clients):
+            await ws.close()
+
+        return web.json_response({'dropped': True})
+
+    async def reconnect_pubsub(self, request):
+        for ws in list(self.pubsub_clients):
+            await self._send(ws, json.dumps({'type': 'RECONNECT'}))
+
+        return web.json_response({'reconnecting': True})
+
+    async def stats(self, request):
+        return web.json_response({
+            'lines_sent': self.lines_sent,
+            'whispers_sent': self.whispers_sent,
+            'anilist_requests': self.anilist_requests,
+            'irc_clients': len(self.irc_clients),
+            'pubsub_clients': len(self.pubsub_clients),
+        })
+
+
+async def serve(args, ready=None):
+    runner = web.AppRunner(StandIns(args).app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+
+    if ready is not None:
+        ready.set()
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def serve_in_process(args, ready):
+    asyncio.run(serve(args, ready))
+
+
+# Clients
+
+class LoadLogger(report.MessageLogger):
+    # The report module's MessageLogger as it is, plus counting
+
+    def __init__(self, channel_names, cache_bytes, **kwargs):
+        super().__init__('nearlyontime', 'not-a-token', channel_names, cache_bytes=cache_bytes, **kwargs)
+
+        self.received = 0
+        self.lag = metrics.Histogram(metrics.LATENCY_BUCKETS)
+
+    async def on_channel_message(self, channel_name, message):
+        await super().on_channel_message(channel_name, message)
+
+        self.received += 1
+        self.lag.record(time.time() - float(message.tags['x-sent']))
+
+
+class LoadReciever(report.ReportReciever):
+    # The report module's ReportReciever as it is, with the report workers replaced by a task that just takes reports off its queue
+
+    def __init__(self, **kwargs):
+        super().__init__('123456789', 'not-a-token', **kwargs)
+        self.received = 0
+
+    async def connect(self):
+        drain = asyncio.create_task(self.drain())
+
+        try:
+            await super().connect()
+        finally:
+            drain.cancel()
+
+    async def drain(self):
+        while True:
+            await self.report_queue.get()
+            self.report_done()
+
+    async def on_message(self, topic, whisper):
+        await super().on_message(topic, whisper)
+        self.received += 1
+
+
+def make_airing(session, url, show_ids):
+    # An AiringModule with just what fetch_upcoming_episodes needs set up, the way on_load sets it up
+    Config = airing.AiringModule.Config
+
+    module = airing.AiringModule.__new__(airing.AiringModule)
+    module.conf = types.SimpleNamespace(
+        anilist_url=url,
+        shows=dict.fromkeys(show_ids),
+        anilist_chunk_size=Config.anilist_chunk_size,
+        blacklisted_sites=Config.blacklisted_sites,
+    )
+    module.session = session
+    module.request_slots = asyncio.Semaphore(Config.anilist_concurrency)
+    module.request_budget = ratelimit.TokenBucket(Config.anilist_requests_per_minute, 60)
+    module.media_cache = airing.MediaCache({}, Config.media_cache_ttl.total_seconds(), Config.media_cache_size)
+
+    return module
+
+
+async def fetch_airing(module, stats):
+    # Returns how many episodes came back, how long it took and how many requests the stand-in saw
+    requests = (await stats())['anilist_requests']
+    start = time.monotonic()
+
+    now = datetime.now(timezone.utc)
+    episodes = await module.fetch_upcoming_episodes(now, now + timedelta(days=1))
+
+    return len(episodes), time.monotonic() - start, (await stats())['anilist_requests'] - requests
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def wait_for_recovery(client, trigger):
+    # Time from the trigger until every shard is back and traffic flows again
+    connects = client.metrics.counters['connects']
+    start = time.monotonic()
+    await trigger()
+
+    while client.metrics.counters['connects'] < connects + len(client.shards) or not all(shard.connected for shard in client.shards):
+        await asyncio.sleep(0.005)
+
+    received = client.received
+    while client.received == received:
+        await asyncio.sleep(0.005)
+
+    return time.monotonic() - start
+
+
+def format_histogram(h, scale=1000, unit='ms'):
+    return f'p50 {h.percentile(50) * scale:.2f}{unit}, p99 {h.percentile(99) * scale:.2f}{unit}, max {h.max * scale:.2f}{unit}'
+
+
+async def run(args):
+    base = f'http://{args.host}:{args.port}'
+    ws_base = f'ws://{args.host}:{args.port}'
+
+    channel_names = [f'channel{i}' for i in range(args.channels)]
+    # Everything goes through one session, like the modules do
+    session = sessions.shared.acquire()
+    logger = LoadLogger(channel_names, args.cache_bytes, url=f'{ws_base}/irc', shard_count=args.connections, session=session)
+    reciever = LoadReciever(url=f'{ws_base}/pubsub', session=session)
+    tasks = [asyncio.create_task(logger.connect()), asyncio.create_task(reciever.connect())]
+
+    async def control(action):
+        async with session.post(f'{base}/control/{action}') as response:
+            await response.read()
+
+    print(f'Warming up for {args.warmup}s...')
+    await asyncio.sleep(args.warmup)
+
+    rss_start = rss_bytes()
+    lines_start, whispers_start = logger.received, reciever.received
+    start = time.monotonic()
+
+    print(f'Running for {args.duration}s at {args.rate} lines/s over {args.channels} channels, {args.whisper_rate} whispers/s...')
+    await asyncio.sleep(args.duration)
+
+    elapsed = time.monotonic() - start
+    rss_end = rss_bytes()
+    lines = logger.received - lines_start
+    whispers = reciever.received - whispers_start
+
+    async def stats():
+        async with session.get(f'{base}/control/stats') as response:
+            return await response.json()
+
+    server = await stats()
+
+    irc_recovery = await wait_for_recovery(logger, lambda: control('drop-irc'))
+    pubsub_recovery = await wait_for_recovery(reciever, lambda: control('reconnect-pubsub'))
+
+    # The second time around the show metadata comes from the media cache
+    module = make_airing(session, f'{base}/graphql', [100000 + i for i in range(args.shows)])
+    cold = await fetch_airing(module, stats)
+    warm = await fetch_airing(module, stats)
+
+    await asyncio.gather(logger.close(), reciever.close())
+    await sessions.shared.release()
+    for task in tasks:
+        task.cancel()
+
+    irc = logger.metrics.histograms
+    pubsub = reciever.metrics.histograms
+
+    print()
+    print(f'IRC:      {lines / elapsed:,.0f} lines/s sustained ({server["lines_sent"]:,} sent in total, {args.rate:,} asked for)')
+    print(f'          handler {format_histogram(irc["handler_time"])}')
+    print(f'          parse {format_histogram(irc["parse_time"])}')
+    print(f'          socket to handler {format_histogram(logger.lag)}')
+    print(f'          recovered from a dropped connection in {irc_recovery * 1000:.0f}ms')
+    print(f'PubSub:   {whispers / elapsed:,.1f} whispers/s sustained')
+    print(f'          handler {format_histogram(pubsub["handler_time"])}')
+    print(f'          decode {format_histogram(pubsub["parse_time"])}')
+    print(f'          recovered from a RECONNECT in {pubsub_recovery * 1000:.0f}ms')
+    for label, (episodes, elapsed, requests), note in (('AniList:', cold, ''), ('', warm, ', media cache warm')):
+        print(f'{label:<10}{episodes} episodes for {args.shows} shows in {elapsed * 1000:.0f}ms, {requests} requests{note}')
+    print(f'Memory:   {rss_start / 2**20:.1f}MiB -> {rss_end / 2**20:.1f}MiB RSS ({(rss_end - rss_start) / 2**20:+.1f}MiB)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--serve', action='store_true', help='only run the stand-ins')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rate', type=int, default=2000, help='chat lines per second, over all channels')
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--connections', type=int, default=2, help='IRC connections on the client side')
+    parser.add_argument('--whisper-rate', type=float, default=20)
+    parser.add_argument('--ping-interval', type=float, default=5)
+    parser.add_argument('--shows', type=int, default=300)
+    parser.add_argument('--anilist-latency', type=float, default=0.05, help='seconds added to every AniList response')
+    parser.add_argument('--cache-bytes', type=int, default=1024 * 1024, help='per channel, small enough that the rings wrap during a run')
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--duration', type=float, default=30)
+    args = parser.parse_args()
+
+    if args.serve:
+        print(f'IRC:     ws://{args.host}:{args.port}/irc')
+        print(f'PubSub:  ws://{args.host}:{args.port}/pubsub')
+        print(f'AniList: http://{args.host}:{args.port}/graphql')
+        asyncio.run(serve(args))
+        return
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve_in_process, args=(args, ready), daemon=True)
+    server.start()
+
+    try:
+        if not ready.wait(10):
+            sys.exit('Stand-ins did not start')
+
+        asyncio.run(run(args))
+
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
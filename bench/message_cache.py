@@ -0,0 +1,140 @@
+# Compares the MessageRing chat cache with the dict + deque cache MessageLogger used to have
+# Usage: python bench/message_cache.py [-m MESSAGES] [--budget BYTES]
+#
+# Each store runs in its own process so the RSS numbers don't bleed into each other.
+
+import argparse
+import gc
+import multiprocessing
+import os
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from chatlog import Message, MessageRing
+
+
+class DictDequeCache:
+    # The old MessageLogger storage, kept here as the baseline
+    def __init__(self, size):
+        self.size = size
+        self._id_queue = deque(maxlen=size)
+        self.messages = {}
+
+    def add(self, msg):
+        if len(self._id_queue) == self.size:
+            del self.messages[self._id_queue[0]]
+
+        self._id_queue.append(msg.id)
+        self.messages[msg.id] = msg
+
+    def get(self, msg_id):
+        return self.messages.get(msg_id)
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+
+def make_messages(count, batch=10_000):
+    rng = random.Random(1234)
+    senders = [f'viewer_{i}' for i in range(2000)]
+    words = 'the run is going great pog kappa lul what was that skip chat gg no way clip it'.split()
+    ts = 1642696567751
+
+    for start in range(0, count, batch):
+        # Every message gets freshly allocated strings, like it would coming off the socket
+        yield [
+            Message(
+                str(uuid.UUID(int=rng.getrandbits(128))),
+                ''.join(rng.choice(senders)),
+                ' '.join(rng.choices(words, k=rng.randint(1, 20))),
+                ts + i * 50,
+            )
+            for i in range(start, min(count, start + batch))
+        ]
+
+
+def run(name, store_factory, count, queue, trace=False):
+    gc.collect()
+    rss_before = rss_bytes()
+
+    if trace:
+        tracemalloc.start()
+
+    store = store_factory()
+    insert_time = 0
+    recent_ids = deque(maxlen=50_000)
+
+    # Messages are generated in batches and thrown away after inserting, so RSS only grows by what the store keeps
+    for batch in make_messages(count):
+        start = time.perf_counter()
+        for msg in batch:
+            store.add(msg)
+        insert_time += time.perf_counter() - start
+
+        recent_ids.extend(msg.id for msg in batch)
+
+    # Look up recent ids, which is what late reports do
+    ids = list(recent_ids) * 4
+    start = time.perf_counter()
+    for msg_id in ids:
+        store.get(msg_id)
+    lookup_time = time.perf_counter() - start
+
+    lookups = len(ids)
+    del batch, ids, recent_ids
+    gc.collect()
+
+    retained = len(store.messages) if isinstance(store, DictDequeCache) else len(store)
+    rss_after = rss_bytes()
+    traced = tracemalloc.get_traced_memory()[0] if trace else 0
+    tracemalloc.stop()
+
+    queue.put((retained, count / insert_time, lookups / lookup_time, rss_after - rss_before, traced))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--messages', type=int, default=500_000)
+    parser.add_argument('--budget', type=int, default=64 * 1024 * 1024)
+    args = parser.parse_args()
+
+    ring_capacity = MessageRing(args.budget).capacity
+
+    stores = [
+        ('dict+deque', lambda: DictDequeCache(ring_capacity)),
+        ('ring', lambda: MessageRing(args.budget)),
+    ]
+
+    print(f'{args.messages:,} messages, {args.budget:,} byte budget, {ring_capacity:,} slots\n')
+    print(f'{"store":<12} {"retained":>10} {"inserts/s":>12} {"lookups/s":>12} {"RSS delta":>12} {"traced":>12} {"bytes/msg":>10}')
+
+    for name, factory in stores:
+        # Timing and allocation tracing in separate runs, tracemalloc slows everything down a lot
+        retained, inserts, lookups, rss, _ = run_isolated(name, factory, args.messages, False)
+        _, _, _, _, traced = run_isolated(name, factory, args.messages, True)
+
+        print(f'{name:<12} {retained:>10,} {inserts:>12,.0f} {lookups:>12,.0f} {rss:>12,} {traced:>12,} {traced / max(retained, 1):>10.0f}')
+
+
+def run_isolated(name, factory, count, trace):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run, args=(name, factory, count, queue, trace))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == '__main__':
+    main()
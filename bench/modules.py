@@ -0,0 +1,24 @@
+# Loads the repo's modules for the benchmarks
+#
+# The modules import each other and the bot framework relative to their package, so the repo is loaded
+# as a package under gs6ex.modules, the same way the bot loads it. Needs gs6ex importable.
+
+import importlib
+import os
+import sys
+import types
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PACKAGE = 'gs6ex.modules.nearly_on_time_bench'
+
+
+def load(*names):
+    if PACKAGE not in sys.modules:
+        import gs6ex.modules
+
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [ROOT]
+        sys.modules[PACKAGE] = package
+
+    return [importlib.import_module(f'{PACKAGE}.{name}') for name in names]
@@ -0,0 +1,480 @@
+# Chat message storage for the report module
+# Keeps as much chat as fits into a fixed memory budget, without an object per message.
+
+import bisect
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+
+
+log = logging.getLogger('chatlog')
+
+
+Message = namedtuple('Message', 'id sender content timestamp')
+
+
+# Fixed cost of a slot: its array entries, the sender pointer, and two entries of the index table
+SLOT_BYTES = 8 + 2 + 4 + 8 + 8 + 8 + 2 * 4
+
+# Id plus text of an average chat message in UTF-8, used to split the budget between slots and the arena
+AVERAGE_RECORD_BYTES = 100
+
+# Twitch caps messages at 500 characters, so this always fits at least one
+MIN_ARENA_BYTES = 4096
+
+
+class MessageRing:
+    # Messages live in a circular byte arena as UTF-8 id + content records.
+    # Everything else is kept in preallocated per-slot arrays, and the id index is an open addressing
+    # table of slot numbers, so storing a message doesn't keep any per-message Python objects alive.
+
+    def __init__(self, budget_bytes, on_evict=None):
+        self.budget_bytes = budget_bytes
+        self.on_evict = on_evict
+        self.capacity = max(1, budget_bytes // (SLOT_BYTES + AVERAGE_RECORD_BYTES))
+
+        self._arena = bytearray(max(MIN_ARENA_BYTES, budget_bytes - self.capacity * SLOT_BYTES))
+        self._write_pos = 0
+
+        self._offsets = array('q', bytes(8 * self.capacity))
+        self._id_lengths = array('H', bytes(2 * self.capacity))
+        self._lengths = array('I', bytes(4 * self.capacity))
+        self._timestamps = array('q', bytes(8 * self.capacity))
+        self._hashes = array('q', bytes(8 * self.capacity))
+        self._senders = [None] * self.capacity
+
+        # Linear probing, at most half full. Holds slot numbers, -1 is empty.
+        self._mask = (1 << (2 * self.capacity - 1).bit_length()) - 1
+        self._table = array('i', [-1]) * (self._mask + 1)
+
+        self._head = 0
+        self._count = 0
+        self.evicted = 0
+
+    @property
+    def footprint(self):
+        # What the ring costs at most, whether it's full or not
+        return len(self._arena) + self.capacity * SLOT_BYTES
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, msg_id):
+        return self._find(msg_id.encode(), hash(msg_id)) != -1
+
+    def _oldest(self):
+        oldest = self._head - self._count
+        return oldest + self.capacity if oldest < 0 else oldest
+
+    def _evict_oldest(self):
+        slot = self._oldest()
+
+        if self.on_evict is not None:
+            self.on_evict(self._read(slot))
+
+        self._unindex(slot)
+        self._senders[slot] = None
+        self._count -= 1
+        self.evicted += 1
+
+    def _unindex(self, slot):
+        table = self._table
+        hashes = self._hashes
+        mask = self._mask
+
+        i = hashes[slot] & mask
+        while table[i] != slot:
+            i = (i + 1) & mask
+
+        # Backward shift deletion, so lookups never need tombstones
+        j = i
+        while True:
+            j = (j + 1) & mask
+            other = table[j]
+            if other == -1:
+                break
+
+            home = hashes[other] & mask
+            if (i < home <= j) if i <= j else (home > i or home <= j):
+                continue
+
+            table[i] = other
+            i = j
+
+        table[i] = -1
+
+    def _reserve(self, size):
+        pos = self._write_pos
+        offsets = self._offsets
+
+        if pos + size > len(self._arena):
+            # Doesn't fit before the end, everything from here on is from the previous lap
+            while self._count and offsets[self._oldest()] >= pos:
+                self._evict_oldest()
+
+            pos = 0
+
+        end = pos + size
+
+        while self._count:
+            oldest = self._oldest()
+
+            if self._count < self.capacity and (offsets[oldest] >= end or offsets[oldest] + self._lengths[oldest] <= pos):
+                break
+
+            self._evict_oldest()
+
+        self._write_pos = end
+        return pos
+
+    def add(self, msg):
+        msg_id, sender, content, timestamp = msg
+        encoded_id = msg_id.encode()
+        h = hash(msg_id)
+
+        # The same message can show up twice while a channel moves between shards
+        if self._find(encoded_id, h) != -1:
+            return
+
+        record = encoded_id + content.encode()[:len(self._arena) - len(encoded_id)]
+        size = len(record)
+        pos = self._reserve(size)
+
+        slot = self._head
+        self._arena[pos:pos + size] = record
+        self._offsets[slot] = pos
+        self._id_lengths[slot] = len(encoded_id)
+        self._lengths[slot] = size
+        self._timestamps[slot] = timestamp
+        self._hashes[slot] = h
+        self._senders[slot] = sys.intern(sender)
+
+        table = self._table
+        mask = self._mask
+        i = h & mask
+        while table[i] != -1:
+            i = (i + 1) & mask
+
+        table[i] = slot
+
+        self._head = slot + 1 if slot + 1 < self.capacity else 0
+        self._count += 1
+
+    def _find(self, encoded_id, h):
+        table = self._table
+        mask = self._mask
+        i = h & mask
+
+        while (slot := table[i]) != -1:
+            # Hashes can collide, so check the stored id too
+            if self._hashes[slot] == h:
+                pos = self._offsets[slot]
+                if self._arena[pos:pos + self._id_lengths[slot]] == encoded_id:
+                    return slot
+
+            i = (i + 1) & mask
+
+        return -1
+
+    def _read(self, slot):
+        pos = self._offsets[slot]
+        id_end = pos + self._id_lengths[slot]
+
+        return Message(
+            self._arena[pos:id_end].decode(),
+            self._senders[slot],
+            self._arena[id_end:pos + self._lengths[slot]].decode(errors='ignore'),
+            self._timestamps[slot],
+        )
+
+    def get(self, msg_id):
+        slot = self._find(msg_id.encode(), hash(msg_id))
+        if slot == -1:
+            return None
+
+        return self._read(slot)
+
+    def __iter__(self):
+        # Oldest first
+        for i in range(self._count):
+            yield self._read((self._oldest() + i) % self.capacity)
+
+
+# On-disk archive for messages that fell out of the ring.
+#
+# A channel's archive is a directory of numbered segments. Each segment is a .log file of records
+# (header, then UTF-8 id, sender and content) and, once it's full or old enough, a .idx file of (id hash, offset)
+# pairs sorted by hash. Lookups binary search the memory-mapped indexes, newest segment first,
+# so nothing but the segment currently being written to is indexed in memory.
+
+RECORD_HEADER = struct.Struct('<qHHH')
+INDEX_ENTRY = struct.Struct('<qI')
+
+# Seconds between checks for a segment to rotate or expire, appends and lookups only check this often
+MAINTENANCE_INTERVAL = 60
+
+# Sealed segments kept memory-mapped at once, over all channels. Each one holds two file descriptors,
+# and a lookup of an unknown id goes through every segment there is.
+MAX_MAPPED_SEGMENTS = 32
+
+
+def stable_hash(encoded_id):
+    # hash() is salted per process, these end up on disk
+    return int.from_bytes(hashlib.blake2b(encoded_id, digest_size=8).digest(), 'little', signed=True)
+
+
+class ArchiveSegment:
+    # The segments that are mapped right now, least recently used first
+    _mapped = OrderedDict()
+
+    def __init__(self, directory, number):
+        self.number = number
+        self.log_path = os.path.join(directory, f'{number:08d}.log')
+        self.index_path = os.path.join(directory, f'{number:08d}.idx')
+        self._log_map = None
+        self._index_map = None
+
+    @property
+    def sealed(self):
+        return os.path.exists(self.index_path)
+
+    def size(self):
+        return sum(os.path.getsize(path) for path in (self.log_path, self.index_path) if os.path.exists(path))
+
+    def last_write(self):
+        return os.path.getmtime(self.log_path)
+
+    def _maps(self):
+        if self._index_map is not None:
+            self._mapped.move_to_end(self)
+
+        else:
+            with open(self.log_path, 'rb') as log_file, open(self.index_path, 'rb') as index_file:
+                self._log_map = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(self.log_path) else b''
+                self._index_map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(self.index_path) else b''
+
+            self._mapped[self] = None
+            while len(self._mapped) > MAX_MAPPED_SEGMENTS:
+                oldest, _ = self._mapped.popitem(last=False)
+                oldest.close()
+
+        return self._log_map, self._index_map
+
+    def find(self, encoded_id, h):
+        log_map, index_map = self._maps()
+        count = len(index_map) // INDEX_ENTRY.size
+
+        lo = bisect.bisect_left(range(count), h, key=lambda i: INDEX_ENTRY.unpack_from(index_map, i * INDEX_ENTRY.size)[0])
+
+        for i in range(lo, count):
+            entry_hash, offset = INDEX_ENTRY.unpack_from(index_map, i * INDEX_ENTRY.size)
+            if entry_hash != h:
+                break
+
+            msg = read_record(log_map, offset)
+            if msg.id == encoded_id.decode():
+                return msg
+
+        return None
+
+    def seal(self, entries=None):
+        # Writes the sorted index. Without entries, they're rebuilt from the log (after a crash or restart).
+        if entries is None:
+            with open(self.log_path, 'rb') as f:
+                data = f.read()
+
+            entries = []
+            offset = 0
+            while offset + RECORD_HEADER.size <= len(data):
+                _, id_length, sender_length, content_length = RECORD_HEADER.unpack_from(data, offset)
+                end = offset + RECORD_HEADER.size + id_length + sender_length + content_length
+                if end > len(data):
+                    break  # torn write at the end
+
+                id_start = offset + RECORD_HEADER.size
+                entries.append((stable_hash(data[id_start:id_start + id_length]), offset))
+                offset = end
+
+        entries.sort()
+
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(INDEX_ENTRY.pack(h, offset) for h, offset in entries))
+
+        os.replace(tmp_path, self.index_path)
+
+    def close(self):
+        for m in (self._log_map, self._index_map):
+            if isinstance(m, mmap.mmap):
+                m.close()
+
+        self._log_map = self._index_map = None
+        self._mapped.pop(self, None)
+
+    def delete(self):
+        self.close()
+
+        for path in (self.log_path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def encode_record(msg):
+    encoded_id = msg.id.encode()
+    sender = msg.sender.encode()
+    content = msg.content.encode()[:0xffff]
+    return encoded_id, RECORD_HEADER.pack(msg.timestamp, len(encoded_id), len(sender), len(content)) + encoded_id + sender + content
+
+
+def read_record(data, offset):
+    timestamp, id_length, sender_length, content_length = RECORD_HEADER.unpack_from(data, offset)
+    pos = offset + RECORD_HEADER.size
+
+    msg_id = bytes(data[pos:pos + id_length]).decode()
+    pos += id_length
+    sender = bytes(data[pos:pos + sender_length]).decode()
+    pos += sender_length
+    content = bytes(data[pos:pos + content_length]).decode(errors='ignore')
+
+    return Message(msg_id, sender, content, timestamp)
+
+
+class MessageArchive:
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024, max_age=7 * 24 * 3600, segment_age=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # A segment is sealed after this long even if it isn't full, so a quiet channel's messages can expire too.
+        # Nothing outlives max_age by more than this.
+        self.segment_age = segment_age if segment_age is not None else max_age / 8
+
+        os.makedirs(directory, exist_ok=True)
+
+        numbers = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log') and name[:-4].isdigit())
+        self.segments = [ArchiveSegment(directory, number) for number in numbers]
+
+        # Whatever we were writing to last time gets sealed, and we start a fresh segment
+        for segment in self.segments:
+            if not segment.sealed:
+                segment.seal()
+
+        self._active = None
+        self._active_file = None
+        self._active_index = {}
+        self._active_size = 0
+        self._active_started = 0
+        self._next_maintenance = 0
+
+        self.expire()
+
+    def _open_segment(self):
+        number = self.segments[-1].number + 1 if self.segments else 0
+        self._active = ArchiveSegment(self.directory, number)
+        self._active_file = open(self._active.log_path, 'ab')
+        self._active_index = {}
+        self._active_size = 0
+        self._active_started = time.time()
+        self.segments.append(self._active)
+
+    def _seal_active(self):
+        self._active_file.close()
+        self._active.seal([(h, offset) for h, offsets in self._active_index.items() for offset in offsets])
+
+        self._active = None
+        self._active_file = None
+        self._active_index = {}
+
+    def append(self, msg):
+        if self._active is None:
+            self._open_segment()
+
+        encoded_id, record = encode_record(msg)
+
+        self._active_index.setdefault(stable_hash(encoded_id), []).append(self._active_size)
+        self._active_file.write(record)
+        self._active_size += len(record)
+
+        if self._active_size >= self.segment_bytes:
+            self._seal_active()
+            self.expire()
+        else:
+            self.maintain()
+
+    def maintain(self, force=False):
+        # Seals the active segment once it's old enough and drops whatever is past the limits.
+        # Cheap to call often, it only looks at the files every MAINTENANCE_INTERVAL seconds unless forced.
+        now = time.time()
+        if not force and now < self._next_maintenance:
+            return
+
+        self._next_maintenance = now + MAINTENANCE_INTERVAL
+
+        if self._active is not None and now - self._active_started >= self.segment_age:
+            self._seal_active()
+
+        self.expire()
+
+    def get(self, msg_id):
+        self.maintain()
+
+        encoded_id = msg_id.encode()
+        h = stable_hash(encoded_id)
+
+        if self._active is not None and h in self._active_index:
+            self._active_file.flush()
+
+            with open(self._active.log_path, 'rb') as f:
+                for offset in self._active_index[h]:
+                    header = os.pread(f.fileno(), RECORD_HEADER.size, offset)
+                    _, id_length, sender_length, content_length = RECORD_HEADER.unpack(header)
+                    msg = read_record(header + os.pread(f.fileno(), id_length + sender_length + content_length, offset + RECORD_HEADER.size), 0)
+
+                    if msg.id == msg_id:
+                        return msg
+
+        for segment in reversed(self.segments):
+            if segment is self._active:
+                continue
+
+            try:
+                msg = segment.find(encoded_id, h)
+            except (OSError, ValueError):
+                log.warning(f'Could not read archive segment {segment.log_path}', exc_info=True)
+                continue
+
+            if msg is not None:
+                return msg
+
+        return None
+
+    def expire(self):
+        # Drop the oldest sealed segments until we're within both the age and the size limit
+        now = time.time()
+        total = sum(segment.size() for segment in self.segments)
+
+        while self.segments and self.segments[0] is not self._active:
+            oldest = self.segments[0]
+
+            if total <= self.max_bytes and now - oldest.last_write() <= self.max_age:
+                break
+
+            total -= oldest.size()
+            oldest.delete()
+            self.segments.pop(0)
+            log.debug(f'Expired archive segment {oldest.log_path}')
+
+    def close(self):
+        if self._active is not None:
+            self._seal_active()
+
+        for segment in self.segments:
+            segment.close()
@@ -0,0 +1,100 @@
+# Write-behind for module configs
+#
+# Every conf.commit() writes out the whole config. Code that changes it often marks it as changed instead,
+# and the writer commits once per interval, or sooner once enough changes have piled up. Changes that can't
+# be lost in a crash, like the record that keeps an episode from being announced twice, are committed right away.
+
+import asyncio
+import logging
+import time
+
+from .metrics import LATENCY_BUCKETS, Histogram
+
+
+log = logging.getLogger('confwriter')
+
+
+class ConfigWriter:
+    def __init__(self, conf, interval=5, max_changes=100):
+        self.conf = conf
+        self.interval = interval
+        self.max_changes = max_changes
+
+        # Changes since the last commit
+        self.changes = 0
+        self._enough = asyncio.Event()
+        # Only one commit at a time, a forced one waits for a background one that's already writing
+        self._lock = asyncio.Lock()
+
+        self.stats = {'changes': 0, 'commits': 0, 'forced': 0, 'failed': 0}
+        self.commit_time = Histogram(LATENCY_BUCKETS)
+        self.task = asyncio.create_task(self._flusher())
+
+    def changed(self, count=1):
+        self.changes += count
+        self.stats['changes'] += count
+
+        if self.changes >= self.max_changes:
+            self._enough.set()
+
+    async def commit(self):
+        # For changes that have to be on disk before we carry on
+        self.changed()
+        await self.flush(forced=True)
+
+    async def flush(self, forced=False):
+        async with self._lock:
+            if not self.changes:
+                return False
+
+            changes, self.changes = self.changes, 0
+            start = time.perf_counter()
+
+            try:
+                await self.conf.commit()
+            except BaseException:
+                # Still unwritten, the next flush picks them up again
+                self.changes += changes
+                self.stats['failed'] += 1
+                raise
+
+            self.commit_time.record(time.perf_counter() - start)
+            self.stats['commits'] += 1
+            self.stats['forced'] += forced
+
+            return True
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._enough.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self._enough.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('Config commit failed, retrying next interval')
+
+    async def close(self):
+        # Whatever is still waiting gets written before we go
+        self.task.cancel()
+
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+        await self.flush(forced=True)
+
+    def summary(self):
+        stats = self.stats
+        commit_time = self.commit_time
+
+        return (
+            f'{stats["changes"]} config changes in {stats["commits"]} commits ({stats["forced"]} forced, {stats["failed"]} failed), '
+            f'{self.changes} unwritten, commit p50 {commit_time.percentile(50) * 1000:.1f}ms, '
+            f'p99 {commit_time.percentile(99) * 1000:.1f}ms, max {commit_time.max * 1000:.1f}ms'
+        )
@@ -0,0 +1,69 @@
+# Schema-specific JSON decoders
+#
+# These go straight from the raw response to namedtuples holding only the fields we actually read,
+# instead of building an Obj for every nested dict. orjson is used when it's installed.
+
+from collections import namedtuple
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+# AniList
+
+AiringSchedule = namedtuple('AiringSchedule', 'media_id episode airing_at')
+AiringPage = namedtuple('AiringPage', 'has_next_page last_page schedules')
+MediaInfo = namedtuple('MediaInfo', 'id title info_url image links')
+
+
+def decode_anilist_response(raw):
+    resp = json_loads(raw)
+    return resp.get('data'), resp.get('errors')
+
+
+def decode_airing_page(data):
+    page = data['Page']
+    page_info = page['pageInfo']
+
+    return AiringPage(
+        has_next_page=page_info['hasNextPage'],
+        last_page=page_info['lastPage'],
+        schedules=[
+            AiringSchedule(schedule['mediaId'], schedule['episode'], schedule['airingAt'])
+            for schedule in page['airingSchedules']
+        ],
+    )
+
+
+def decode_media_page(data):
+    return [
+        MediaInfo(
+            id=media['id'],
+            title=media['title']['english'] or media['title']['romaji'],
+            info_url=media['siteUrl'],
+            image=media['coverImage']['medium'],
+            links=[(link['site'], link['url']) for link in media['externalLinks']],
+        )
+        for media in data['Page']['media']
+    ]
+
+
+# Twitch PubSub
+
+Whisper = namedtuple('Whisper', 'sender body')
+
+
+def decode_whisper(raw):
+    # The whispers topic also carries thread updates and the like, those are dropped before parsing anything
+    if '"whisper_received"' not in raw:
+        return None
+
+    message = json_loads(raw)
+    if message.get('type') != 'whisper_received':
+        return None
+
+    # The whisper itself is JSON inside a string, one more level down
+    data = json_loads(message['data'])
+    return Whisper(data['tags']['login'], data['body'])
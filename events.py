@@ -1,97 +1,411 @@
-# TODO Don't forget to remove this ~hmry (2019-08-16, 01:11)
-raise NotImplementedError("The events module isn't functional yet.")
-
+import asyncio
+import bisect
+import hashlib
+import heapq
+import re
 from collections import namedtuple
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import islice
+from operator import attrgetter
 
+import aiohttp
 import discord
-from dateutil import tz
+from dateutil import rrule, tz
 
 from ...common import *
 from ... import module as mod
+from . import sessions
+
+
+log = mod.get_logger()
 
 
 Location = namedtuple('Location', 'url icon_url color')
 locations = {
     'Twitch Channel': ('https://i.imgur.com/DKfwzn4.png', 0x6441a4, 'https://www.twitch.tv/nearlyonred')
 }
+default_location = (None, 0, None)
 
 
 class Event:
     def __init__(self):
+        self.uid = None
         self.title = None
         self.description = None
         self.start_time = None
         self.end_time = None
         self.location = None
+        self.rrule = None
+        self.exdates = []
 
     def __repr__(self):
         return f'({self.title} @ {self.location} @ {self.start_time} - {self.end_time})'
 
+    def recurrence(self):
+        # The start times of a recurring event, as a lazy dateutil rule set. None for one-off events.
+        if self.rrule is None:
+            return None
+
+        rules = rrule.rruleset()
+        rules.rrule(rrule.rrulestr(self.rrule, dtstart=self.start_time))
+
+        for exdate in self.exdates:
+            rules.exdate(exdate)
+
+        return rules
+
+
+Occurrence = namedtuple('Occurrence', 'start end event')
+
+
+class EventIndex:
+    # One-off events are kept sorted by start time, so finding where a query begins is a bisect.
+    # Recurring events are kept as rules and only expanded as far as a query actually reads.
+
+    def __init__(self, events):
+        occurrences = []
+        self.recurring = []
+
+        for event in events:
+            try:
+                rules = event.recurrence()
+            except ValueError:
+                log.warning(f'Unreadable recurrence rule {event.rrule!r} on {event}, only using the first time', exc_info=True)
+                rules = None
+
+            if rules is None:
+                occurrences.append(Occurrence(event.start_time, event.end_time, event))
+            else:
+                self.recurring.append((event, rules, event.end_time - event.start_time))
+
+        occurrences.sort(key=attrgetter('start'))
+        self.occurrences = occurrences
+        self.starts = [occurrence.start for occurrence in occurrences]
+
+        # Anything running at some time t started no more than this long before it
+        self.max_duration = max((o.end - o.start for o in occurrences), default=timedelta(0))
+
+    def __len__(self):
+        return len(self.occurrences) + len(self.recurring)
+
+    def _one_off_from(self, i):
+        for j in range(i, len(self.occurrences)):
+            yield self.occurrences[j]
+
+    def _recurring_after(self, event, rules, duration, t, inclusive):
+        for start in rules.xafter(t, inc=inclusive):
+            yield Occurrence(start, start + duration, event)
+
+    def after(self, t, count, inclusive=True):
+        # The next count occurrences starting at (or strictly after) t
+        i = bisect.bisect_left(self.starts, t) if inclusive else bisect.bisect_right(self.starts, t)
+
+        sources = [self._one_off_from(i)]
+        sources += [self._recurring_after(event, rules, duration, t, inclusive) for event, rules, duration in self.recurring]
+
+        return list(islice(heapq.merge(*sources, key=attrgetter('start')), count))
+
+    def between(self, start, end):
+        # Everything that overlaps [start, end), in order of start time
+        lo = bisect.bisect_left(self.starts, start - self.max_duration)
+        hi = bisect.bisect_left(self.starts, end)
+        found = [o for o in self.occurrences[lo:hi] if o.end > start or o.start >= start]
+
+        for event, rules, duration in self.recurring:
+            for occurrence_start in rules.between(start - duration, end, inc=True):
+                if occurrence_start < end and (occurrence_start + duration > start or occurrence_start >= start):
+                    found.append(Occurrence(occurrence_start, occurrence_start + duration, event))
+
+        found.sort(key=attrgetter('start'))
+        return found
+
+    def at(self, t):
+        # Everything running at t
+        lo = bisect.bisect_left(self.starts, t - self.max_duration)
+        hi = bisect.bisect_right(self.starts, t)
+        found = [o for o in self.occurrences[lo:hi] if o.end > t]
+
+        for event, rules, duration in self.recurring:
+            for occurrence_start in rules.between(t - duration, t, inc=True):
+                if occurrence_start + duration > t:
+                    found.append(Occurrence(occurrence_start, occurrence_start + duration, event))
+
+        found.sort(key=attrgetter('start'))
+        return found
+
+
+# iCal parsing (RFC 5545)
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    # Every event in the feed names the same one or two zones, no need to look them up every time.
+    # Windows names and zones only defined in the feed's VTIMEZONE blocks aren't known, those are taken as UTC
+    # so every time stays comparable with the others.
+    zone = tz.gettz(name)
+
+    if zone is None:
+        log.warning(f'Unknown time zone {name!r} in the event feed, using UTC')
+        return timezone.utc
+
+    return zone
+
+
+async def unfold_lines(stream):
+    # Long lines are split with a line break followed by a space or tab, those are glued back together here.
+    # Works on bytes, since a fold can land in the middle of a multi-byte character.
+    current = None
+
+    async for raw_line in stream:
+        line = raw_line.rstrip(b'\r\n')
+
+        if line[:1] in (b' ', b'\t'):
+            if current is not None:
+                current += line[1:]
+            continue
+
+        if current:
+            yield current.decode('utf-8', errors='replace')
+
+        current = line
+
+    if current:
+        yield current.decode('utf-8', errors='replace')
+
+
+def parse_content_line(line):
+    # NAME;PARAM=VALUE;PARAM="QUOTED:VALUE":value -> (name, params, value)
+    quoted = False
+
+    for i, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ':' and not quoted:
+            break
+    else:
+        return line.upper(), {}, ''
+
+    name, *params = line[:i].split(';')
+    params = dict(param.split('=', maxsplit=1) for param in params if '=' in param)
+
+    return name.upper(), {key.upper(): value.strip('"') for key, value in params.items()}, line[i + 1:]
+
+
+escape_re = re.compile(r'\\([\\;,nN])')
+escape_values = {'\\': '\\', ';': ';', ',': ',', 'n': '\n', 'N': '\n'}
+
+def unescape_text(value):
+    return escape_re.sub(lambda m: escape_values[m.group(1)], value)
+
+
+def parse_datetime(params, value):
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        # All-day, taken as starting at midnight in whatever zone it says (or UTC)
+        time = datetime.strptime(value, '%Y%m%d')
+    else:
+        time = datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S')
+
+    if value.endswith('Z'):
+        return time.replace(tzinfo=timezone.utc)
+
+    return time.replace(tzinfo=get_timezone(params['TZID']) if 'TZID' in params else timezone.utc)
+
+
+async def parse_events(lines):
+    events = []
+    curr_event = None
+
+    async for line in lines:
+        name, params, value = parse_content_line(line)
+
+        if name == 'BEGIN' and value == 'VEVENT':
+            curr_event = Event()
+
+        elif curr_event is None:
+            # Calendar properties and timezone definitions, we only care about events
+            continue
+
+        elif name == 'END' and value == 'VEVENT':
+            if curr_event.start_time is not None:
+                if curr_event.end_time is None:
+                    curr_event.end_time = curr_event.start_time
+
+                events.append(curr_event)
+
+            curr_event = None
+
+        elif name == 'UID':
+            curr_event.uid = value
+
+        elif name == 'SUMMARY':
+            curr_event.title = unescape_text(value)
+
+        elif name == 'DESCRIPTION':
+            curr_event.description = unescape_text(value)
+
+        elif name == 'LOCATION':
+            curr_event.location = unescape_text(value)
+
+        elif name == 'DTSTART':
+            curr_event.start_time = parse_datetime(params, value)
+
+        elif name == 'DTEND':
+            curr_event.end_time = parse_datetime(params, value)
+
+        elif name == 'RRULE':
+            curr_event.rrule = value
+
+        elif name == 'EXDATE':
+            curr_event.exdates += [parse_datetime(params, exdate) for exdate in value.split(',')]
+
+    return events
+
 
 class EventsModule(mod.Module):
-    def __init__(self, bot):
-        self.bot = bot
+    class Config(mod.Config):
+        ical_url: str = 'https://www.nearlyonred.com/events/list/?ical=1&tribe_display=custom&start_date=2019&end_date=2100'
+        refresh_interval: timedelta = timedelta(hours=1)
+        reminder_channel_id: int = 0
+        reminder_lead: timedelta = timedelta(minutes=15)
+
+    async def on_load(self):
+        self.session = sessions.shared.acquire()
         self.events = []
-        self.reload_events()
+        self.index = EventIndex([])
+        self.index_changed = asyncio.Event()
+
+        # What we got last time, so unchanged feeds cost a 304 and nothing else
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+
+        self.reminder_task = None
+        if self.conf.reminder_channel_id:
+            self.reminder_task = asyncio.create_task(self.send_reminders())
+
+        self.schedule_repeated(self.reload_events, every_delta=self.conf.refresh_interval)
+
+    async def on_unload(self):
+        if self.reminder_task is not None:
+            self.reminder_task.cancel()
+
+        await sessions.shared.release()
+
+    def build_embed(self, occurrence):
+        event = occurrence.event
+        loc_img, loc_color, loc_url = locations.get(event.location, default_location)
+
+        embed = discord.Embed(
+            title=(event.title or 'Untitled event').strip(),
+            colour=discord.Colour(loc_color),
+            url=loc_url,
+            description=(event.description or '').strip() + f'\n\n*{occurrence.end - occurrence.start}, starting at:*',
+            timestamp=occurrence.start)
+
+        if event.location:
+            embed.set_author(name=event.location, url=loc_url, icon_url=loc_img)
+
+        return embed
 
     @mod.group(name='events', invoke_without_command=True)
     @mod.is_owner()
-    async def events_cmd(self, ctx):
-        await ctx.send(content="__***Upcoming Events:***__")
+    async def events_cmd(self, ctx, count: int = 5):
+        # Whatever is on right now, then the next few. Discord takes up to 10 embeds per message.
+        now = datetime.now(timezone.utc)
+        count = max(1, min(count, 10))
 
-        for event in sorted(self.events, key=lambda x: x.start_time):
-            loc_img, loc_color, loc_url = locations.get(event.location)
+        running = self.index.at(now)[:count]
+        upcoming = running + self.index.after(now, count - len(running), inclusive=False)
 
-            embed = discord.Embed(
-                title=event.title.strip(),
-                colour=discord.Colour(loc_color),
-                url=loc_url,
-                description=event.description.strip() + f'\n\n*{event.end_time - event.start_time}, starting at:*',
-                timestamp=event.start_time)
+        if not upcoming:
+            await ctx.send('No upcoming events.')
+            return
+
+        await ctx.send(content="__***Upcoming Events:***__", embeds=[self.build_embed(occurrence) for occurrence in upcoming])
+
+    async def send_reminders(self):
+        # One timer for all reminders: sleep until the next event is due, or until the events change
+        reminded_through = datetime.now(timezone.utc)
+
+        while True:
+            upcoming = self.index.after(reminded_through, 10, inclusive=False)
+
+            if upcoming:
+                start = upcoming[0].start
+                timeout = max(0, (start - self.conf.reminder_lead - datetime.now(timezone.utc)).total_seconds())
+            else:
+                timeout = None
+
+            try:
+                await asyncio.wait_for(self.index_changed.wait(), timeout)
+                self.index_changed.clear()
+                continue
+
+            except asyncio.TimeoutError:
+                pass
+
+            channel = self.bot.get_channel(self.conf.reminder_channel_id)
+            due = [occurrence for occurrence in upcoming if occurrence.start == start]
+
+            try:
+                await channel.send(content='__***Starting Soon:***__', embeds=[self.build_embed(occurrence) for occurrence in due])
+            except (AttributeError, discord.HTTPException):
+                log.exception(f'Failed to send reminder for {[occurrence.event for occurrence in due]}')
+
+            reminded_through = start
 
-            embed.set_author(name=event.location, url=loc_url, icon_url=loc_img)
-            await ctx.send(embed=embed)
-        
 
     @events_cmd.command(name='reload')
     @mod.is_owner()
     async def reload_cmd(self, ctx):
-        self.reload_events()
-
-    def reload_events(self):
-        # TODO Get the info from the export plugin ~hmry (2019-08-16, 01:11)
-        # ical = www.nearlyonred.com/events/list/?ical=1&tribe_display=custom&start_date=2019&end_date=2100
-
-        ical_elements = [tuple(line.split(':', maxsplit=1)) for line in ical.split('\n')]
+        if await self.reload_events():
+            await ctx.send(f'Loaded {len(self.events)} events.')
+        else:
+            await ctx.send(f'Nothing changed, still {len(self.events)} events.')
 
-        curr_event = None
-        for element in ical_elements:
-            k, v  = element
+    async def reload_events(self):
+        # Returns whether there was anything new
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
 
-            if element == ('BEGIN', 'VEVENT'):
-                curr_event = Event()
+        async with self.session.get(self.conf.ical_url, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as response:
+            if response.status == 304:
+                log.debug('Event feed not modified')
+                return False
 
-            elif element == ('END', 'VEVENT'):
-                self.events.append(curr_event)
+            response.raise_for_status()
 
-            elif k == 'SUMMARY':
-                curr_event.title = v
+            # Some servers ignore the conditional headers, so the body is hashed on its way through as well
+            digest = hashlib.blake2b(digest_size=16)
 
-            elif k == 'DESCRIPTION':
-                curr_event.description = v.replace('\\n', '\n')
+            async def hashed(stream):
+                async for line in stream:
+                    digest.update(line)
+                    yield line
 
-            elif k.startswith('DTSTART'):
-                time_zone = tz.gettz(dict(x.split('=', maxsplit=1) for x in k.split(';', maxsplit=1)[1:])['TZID'])
-                time = datetime.strptime(v, '%Y%m%dT%H%M%S').astimezone(time_zone)
+            events = await parse_events(unfold_lines(hashed(response.content)))
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
 
-                curr_event.start_time = time
+        if digest.digest() == self.digest:
+            self.etag = etag
+            self.last_modified = last_modified
+            log.debug('Event feed unchanged')
+            return False
 
-            elif k.startswith('DTEND'):
-                time_zone = tz.gettz(dict(x.split('=', maxsplit=1) for x in k.split(';', maxsplit=1)[1:])['TZID'])
-                time = datetime.strptime(v, '%Y%m%dT%H%M%S').astimezone(time_zone)
+        # Only replaced once the whole feed has been read and indexed, anything failing before this leaves
+        # the old events and validators in place, so the next poll fetches the feed again instead of getting a 304
+        index = EventIndex(events)
 
-                curr_event.end_time = time
+        self.etag = etag
+        self.last_modified = last_modified
+        self.digest = digest.digest()
+        self.events = events
+        self.index = index
+        self.index_changed.set()
 
-            elif k == 'LOCATION':
-                curr_event.location = v
+        log.info(f'Loaded {len(events)} events')
+        return True
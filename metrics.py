@@ -0,0 +1,100 @@
+# Counters, histograms and rates for the modules' stats
+#
+# Everything here is cheap enough to leave on: counters are dict increments, histograms have fixed
+# buckets so recording a value is one bisect. Nothing is ever logged or formatted on the hot path.
+
+import bisect
+import time
+
+
+# Upper bounds in seconds, from 10us up to 10s
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+# Upper bounds in seconds, for reconnect delays
+BACKOFF_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+# Upper bounds for things counted per second
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last bucket catches everything above the highest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, p):
+        # Upper bound of the bucket the percentile falls into, or the max if that's past the last bound
+        if not self.count:
+            return 0
+
+        rank = p / 100 * self.count
+        seen = 0
+
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': {str(bound): n for bound, n in zip((*self.bounds, 'inf'), self.counts) if n},
+        }
+
+
+class RateMeter:
+    # Counts events per whole second, every finished second goes into a histogram.
+    # Seconds without any events aren't recorded, so this describes the busy seconds only.
+    __slots__ = ('histogram', '_second', '_count')
+
+    def __init__(self, bounds=RATE_BUCKETS):
+        self.histogram = Histogram(bounds)
+        self._second = 0
+        self._count = 0
+
+    def add(self, n=1):
+        second = int(time.monotonic())
+
+        if second != self._second:
+            if self._count:
+                self.histogram.record(self._count)
+
+            self._second = second
+            self._count = 0
+
+        self._count += n
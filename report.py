@@ -1,157 +1,426 @@
 import asyncio
+import io
 import json
-from collections import deque, namedtuple
-from datetime import datetime as dt, timezone as tz
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime as dt, timedelta, timezone as tz
 
 import discord
 
 from ...common import *
 from ... import module as mod
-from . import twitch
+from . import sessions, twitch
+from .chatlog import Message, MessageArchive, MessageRing
+from .confwriter import ConfigWriter
+from .decoders import decode_whisper
+from .reportstore import Report, ReportStore
 
 
 log = mod.get_logger()
 
 
-Message = namedtuple('Message', 'id sender content timestamp')
-Report = namedtuple('Report', 'message reasons discord_id')
+# Per channel. At a few hundred bytes per message this holds hours of busy chat.
+MESSAGE_CACHE_BYTES = 16 * 1024 * 1024
 
+REPORT_QUEUE_SIZE = 1000
 
-MESSAGE_CACHE_SIZE = 1000
+# Posted report messages we hold on to, so updating them doesn't need a fetch
+POSTED_CACHE_SIZE = 500
 
-class MessageLogger(twitch.TwitchIRCSocket):
-    def __init__(self, user_name, oauth_token, channel_name, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+class MessageLogger(twitch.TwitchIRCPool):
+    def __init__(self, user_name, oauth_token, channel_names, *args, cache_bytes=MESSAGE_CACHE_BYTES, archive_path=None, archive_options=None, **kwargs):
+        kwargs.setdefault('lazy_parsing', True)
+        super().__init__(user_name, oauth_token, ('twitch.tv/tags',), *args, **kwargs)
 
-        self.user_name = user_name
-        self.oauth_token = oauth_token
-        self.channel_name = channel_name
+        self.cache_bytes = cache_bytes
+        self.archive_path = archive_path
+        self.archive_options = archive_options or {}
+        self.caches = {}
+        self.archives = {}
 
-        self._id_queue = deque(maxlen=MESSAGE_CACHE_SIZE)
-        self.messages = {}
+        for channel_name in channel_names:
+            self._add_cache(channel_name)
+            self.assign_channel(channel_name)
 
-    async def on_connect(self):
-        await self.login(self.user_name, self.oauth_token)
-        await self.request_capabilities('twitch.tv/tags')
-        await self.join_channel(self.channel_name)
-
-    async def on_message(self, message):
-        if message.command != 'PRIVMSG':
+    def _add_cache(self, channel_name):
+        if channel_name in self.caches:
             return
 
-        msg_id = message.tags['id']
-        msg = Message(msg_id, message.name, message.params[1], int(message.tags['tmi-sent-ts']))
-        
-        if len(self._id_queue) == MESSAGE_CACHE_SIZE:
-            del self.messages[self._id_queue[0]]
-        
-        self._id_queue.append(msg_id)
-        self.messages[msg_id] = msg
+        # Messages that fall out of memory get spilled to disk, if there's somewhere to put them
+        on_evict = None
+        if self.archive_path:
+            archive = self.archives[channel_name] = MessageArchive(os.path.join(self.archive_path, channel_name), **self.archive_options)
+            on_evict = archive.append
+
+        self.caches[channel_name] = MessageRing(self.cache_bytes, on_evict=on_evict)
+
+    async def join_channel(self, channel_name):
+        self._add_cache(channel_name)
+        await super().join_channel(channel_name)
+
+    async def part_channel(self, channel_name):
+        await super().part_channel(channel_name)
+        self.caches.pop(channel_name, None)
+
+        if (archive := self.archives.pop(channel_name, None)) is not None:
+            archive.close()
+
+    async def on_channel_message(self, channel_name, message):
+        msg = Message(message.tags['id'], message.name, message.params[1], int(message.tags['tmi-sent-ts']))
+        self.caches[channel_name].add(msg)
+
+    def maintain_archives(self):
+        # Appends and lookups keep the archives in check, this is for channels where neither happens
+        for archive in self.archives.values():
+            archive.maintain(force=True)
+
+    def get_message(self, msg_id):
+        for cache in self.caches.values():
+            if (msg := cache.get(msg_id)) is not None:
+                return msg
 
-class ReportReciever(twitch.TwitchPubSubSocket):
-    def __init__(self, user_id, oauth_token, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        for archive in self.archives.values():
+            if (msg := archive.get(msg_id)) is not None:
+                return msg
+
+        return None
+
+    async def close(self):
+        await super().close()
+
+        for archive in self.archives.values():
+            archive.close()
+
+        self.archives = {}
+
+class ReportReciever(twitch.TwitchPubSubPool):
+    topic_decoders = {'whispers': decode_whisper}
+    decode_unknown_topics = False
+
+    def __init__(self, user_id, oauth_token, *args, queue_size=REPORT_QUEUE_SIZE, **kwargs):
+        super().__init__(oauth_token, *args, **kwargs)
 
         self.user_id = user_id
-        self.oauth_token = oauth_token
 
+        # Reports taken in and not handled yet. Past queue_size new ones are dropped: waiting for the workers
+        # here would stop the socket from being read, pongs included, and get it reset in the middle of a raid.
         self.report_queue = asyncio.Queue()
+        self.queue_size = queue_size
+        self.backlog = 0
+        self.max_queue_depth = 0
+        self.dropped = 0
 
-    async def on_connect(self):
-        await self.listen_to(self.oauth_token, f'whispers.{self.user_id}')
+    async def connect(self):
+        # The LISTEN is answered once the shard is up, so the pool has to be running while we wait for it
+        running = asyncio.create_task(super().connect())
 
-    async def on_message(self, topic, message):
-        if message.type != 'whisper_received':
-            return
-        
-        data = json.loads(message.data, object_hook=Obj)
-        sender = data.tags.login
-        body = data.body
+        try:
+            await self.listen(f'whispers.{self.user_id}')
+
+        except twitch.PubSubError:
+            log.error('Twitch rejected listening to whispers, no reports will come in', exc_info=True)
+            await self.close()
+            raise
+
+        finally:
+            if self.closed:
+                running.cancel()
+
+        await running
+
+    async def on_message(self, topic, whisper):
+        sender = whisper.sender
+        body = whisper.body
 
         args = body.split()
         if args[0] != 'report' or len(args) != 3:
             log.warning(f'Unrecognizable whisper from {sender}: {body}')
             return
 
-        await self.report_queue.put((sender, args[1], args[2]))
+        if self.backlog >= self.queue_size:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                log.warning(f'Report backlog full, dropped report of {args[1]} by {sender} ({self.dropped} dropped so far)')
+            return
+
+        self.backlog += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.backlog)
+        self.report_queue.put_nowait((sender, args[1], args[2], time.monotonic()))
+
+    def report_done(self):
+        self.backlog -= 1
 
 
 class ReportModule(mod.Module):
     class Config(mod.Config):
+        # Only worth changing to point the bot at a test server
+        twitch_irc_url: str = twitch.IRC_URL
+        twitch_pubsub_url: str = twitch.PUBSUB_URL
         twitch_channel_name: str = ''
+        twitch_channel_names: list[str] = []
+        twitch_connections: int = 1
+        message_cache_bytes: int = MESSAGE_CACHE_BYTES
+        message_archive_path: str = ''
+        message_archive_max_bytes: int = 1024 * 1024 * 1024
+        message_archive_max_age: timedelta = timedelta(days=7)
         reports_channel_id: int = 0
+        report_store_path: str = 'reports'
+        report_retention: timedelta = timedelta(days=180)
+        report_update_delay: timedelta = timedelta(seconds=5)
+        report_workers: int = 4
+        report_queue_size: int = REPORT_QUEUE_SIZE
+        # Old reports from before the report store, moved over and emptied on load
         reports: dict[str, Report] = {}
         reasons: dict[str, str] = {}
 
     async def on_load(self):
+        self.conf_writer = ConfigWriter(self.conf)
+        self.store = ReportStore(self.conf.report_store_path, retention=self.conf.report_retention.total_seconds())
+
+        self._posted = OrderedDict()
+        self._pending_updates = {}
+        self._update_tasks = set()
+        self.update_stats = {'updates': 0, 'edits': 0, 'reposts': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+        self.pipeline_stats = {'processed': 0, 'failed': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+
+        if self.conf.reports:
+            log.info(f'Moving {len(self.conf.reports)} reports from the config into the report store')
+            self.store.import_reports(self.conf.reports)
+            self.conf.reports = {}
+            await self.conf_writer.commit()
+
+        channel_names = [self.conf.twitch_channel_name, *self.conf.twitch_channel_names]
+        self.session = sessions.shared.acquire()
+
         self.ml = MessageLogger(
             self.bot.credentials['twitch_bot_username'],
             self.bot.credentials['twitch_bot_token'],
-            self.conf.twitch_channel_name,
+            list(dict.fromkeys(name for name in channel_names if name)),
+            shard_count=self.conf.twitch_connections,
+            url=self.conf.twitch_irc_url,
+            session=self.session,
+            cache_bytes=self.conf.message_cache_bytes,
+            archive_path=self.conf.message_archive_path or None,
+            archive_options={
+                'max_bytes': self.conf.message_archive_max_bytes,
+                'max_age': self.conf.message_archive_max_age.total_seconds(),
+            },
         )
         self.rr = ReportReciever(
             self.bot.credentials['twitch_bot_id'],
             self.bot.credentials['twitch_bot_token'],
+            queue_size=self.conf.report_queue_size,
+            url=self.conf.twitch_pubsub_url,
+            session=self.session,
         )
 
         self.ml_task = asyncio.create_task(self.ml.connect())
         self.rr_task = asyncio.create_task(self.rr.connect())
 
+        # Reports for the same message always go to the same worker, so they're handled in order
+        # The backlog is bounded as a whole by the reciever, so one slow worker doesn't hold up routing to the others
+        self.worker_queues = [asyncio.Queue() for _ in range(max(1, self.conf.report_workers))]
+        self.worker_tasks = [asyncio.create_task(self.report_worker(queue)) for queue in self.worker_queues]
         self.post_task = asyncio.create_task(self.post_reports())
 
+        if self.conf.message_archive_path:
+            self.schedule_repeated(self.maintain_archives, every_delta=timedelta(minutes=10))
+
+    async def maintain_archives(self):
+        self.ml.maintain_archives()
+
     async def on_unload(self):
         self.post_task.cancel()
 
+        for task in self.worker_tasks:
+            task.cancel()
+
+        for task in self._update_tasks:
+            task.cancel()
+
         self.ml_task.cancel()
         self.rr_task.cancel()
     
-        self.ml.close()
-        self.rr.close()
+        await asyncio.gather(self.ml.close(), self.rr.close())
+        await sessions.shared.release()
+        await self.conf_writer.close()
+
+        self.store.close()
+
+    def build_embed(self, report):
+        message = report.message
+        report_list = '\n'.join(f' - **{self.conf.reasons.get(reason) or f"[{reason}]"}** - {", ".join(reporters)}' for reason, reporters in report.reasons.items())
+
+        return discord.Embed(
+            description=f'**{message.sender}**: {message.content}\n\nReported for:\n' + report_list,
+            timestamp=dt.fromtimestamp(message.timestamp/1000, tz=tz.utc))
 
     async def post_reports(self):
         while True:
-            reporter, message_id, reason = await self.rr.report_queue.get()
-            previous_report = self.conf.reports.get(message_id)
-            
-            channel = self.bot.get_channel(self.conf.reports_channel_id)
-            
-            if previous_report is None:
-                if message_id not in self.ml.messages:
-                    log.warning(f"Report of unknown message {message_id} by {reporter} for {reason}")
-                    continue
-
-                message = self.ml.messages[message_id]
-                reasons = {reason: [reporter]}
-
-            else:
-                message = previous_report.message
-                reasons = previous_report.reasons
-
-                if reason in reasons and reporter in reasons[reason]:
-                    continue
-
-                reasons.setdefault(reason, []).append(reporter)
-
-                if channel and previous_report.discord_id:
-                    try:
-                        previous_message = await channel.fetch_message(previous_report.discord_id)
-                        await previous_message.delete()
-                    
-                    except discord.NotFound:
-                        pass
-
-            
-            discord_id = None
-            
+            item = await self.rr.report_queue.get()
+            message_id = item[1]
+
+            # hash() of a str is stable within a process, which is all the ordering needs
+            self.worker_queues[hash(message_id) % len(self.worker_queues)].put_nowait(item)
+
+    async def report_worker(self, queue):
+        while True:
+            reporter, message_id, reason, received = await queue.get()
+
+            try:
+                await self.handle_report(reporter, message_id, reason)
+
+            except Exception:
+                self.pipeline_stats['failed'] += 1
+                log.exception(f'Failed to handle report of {message_id} by {reporter} for {reason}')
+                continue
+
+            finally:
+                self.rr.report_done()
+
+            latency = time.monotonic() - received
+            self.pipeline_stats['processed'] += 1
+            self.pipeline_stats['latency_total'] += latency
+            self.pipeline_stats['latency_max'] = max(self.pipeline_stats['latency_max'], latency)
+
+    async def handle_report(self, reporter, message_id, reason):
+        previous_report = self.store.get(message_id)
+        
+        channel = self.bot.get_channel(self.conf.reports_channel_id)
+        
+        if previous_report is None:
+            message = self.ml.get_message(message_id)
+
+            if message is None:
+                log.warning(f"Report of unknown message {message_id} by {reporter} for {reason}")
+                return
+
+            report = Report(message, {reason: [reporter]}, None)
+
             if channel:
-                report_list = '\n'.join(f' - **{self.conf.reasons.get(reason) or f"[{reason}]"}** - {", ".join(reporters)}' for reason, reporters in reasons.items())
+                posted = await channel.send(embed=self.build_embed(report))
+                self._remember_posted(message_id, posted)
+                report = report._replace(discord_id=posted.id)
 
-                embed = discord.Embed(
-                    description=f'**{message.sender}**: {message.content}\n\nReported for:\n' + report_list,
-                    timestamp=dt.fromtimestamp(message.timestamp/1000, tz=tz.utc))
+            self.store.put(message_id, report)
 
-                discord_id = (await channel.send(embed=embed)).id
+        else:
+            reasons = previous_report.reasons
+
+            if reason in reasons and reporter in reasons[reason]:
+                return
+
+            reasons.setdefault(reason, []).append(reporter)
+            self.store.put(message_id, previous_report)
+
+            if channel:
+                self._schedule_update(message_id)
+
+    # Updates to an already posted report are coalesced per message and applied as a single edit
+
+    def _remember_posted(self, message_id, posted):
+        self._posted[message_id] = posted
+        self._posted.move_to_end(message_id)
+
+        while len(self._posted) > POSTED_CACHE_SIZE:
+            self._posted.popitem(last=False)
+
+    def _schedule_update(self, message_id):
+        self.update_stats['updates'] += 1
+
+        if message_id in self._pending_updates:
+            return
 
+        self._pending_updates[message_id] = time.monotonic()
 
-            self.conf.reports[message_id] = Report(message, reasons, discord_id)
-            await self.conf.commit()
+        task = asyncio.create_task(self._apply_update(message_id))
+        self._update_tasks.add(task)
+        task.add_done_callback(self._update_tasks.discard)
+
+    async def _apply_update(self, message_id):
+        await asyncio.sleep(self.conf.report_update_delay.total_seconds())
+
+        first_update = self._pending_updates.pop(message_id)
+        report = self.store.get(message_id)
+        channel = self.bot.get_channel(self.conf.reports_channel_id)
+
+        if report is None or channel is None:
+            return
+
+        embed = self.build_embed(report)
+        posted = self._posted.get(message_id)
+
+        # After a restart we don't have the message object anymore, but a partial one is enough to edit
+        if posted is None and report.discord_id:
+            posted = channel.get_partial_message(report.discord_id)
+
+        try:
+            if posted is not None:
+                try:
+                    await posted.edit(embed=embed)
+                    self.update_stats['edits'] += 1
+
+                except discord.NotFound:
+                    # Someone deleted the report message, post it again below
+                    posted = None
+
+            if posted is None:
+                posted = await channel.send(embed=embed)
+                self.store.put(message_id, report._replace(discord_id=posted.id))
+                self.update_stats['reposts'] += 1
+
+        except discord.HTTPException:
+            log.exception(f'Failed to update report for {message_id}')
+            return
+
+        self._remember_posted(message_id, posted)
+
+        latency = time.monotonic() - first_update
+        self.update_stats['latency_total'] += latency
+        self.update_stats['latency_max'] = max(self.update_stats['latency_max'], latency)
+
+    @property
+    def calls_saved(self):
+        # Every update used to be a fetch, a delete and a send
+        stats = self.update_stats
+        return 3 * stats['updates'] - stats['edits'] - stats['reposts']
+
+    @mod.group(name='reports', invoke_without_command=True)
+    @mod.is_owner()
+    async def reports_cmd(self, ctx):
+        stats = self.update_stats
+        applied = stats['edits'] + stats['reposts']
+        average = stats['latency_total'] / applied if applied else 0
+
+        pipeline = self.pipeline_stats
+        pipeline_average = pipeline['latency_total'] / pipeline['processed'] if pipeline['processed'] else 0
+        worker_depths = ', '.join(str(queue.qsize()) for queue in self.worker_queues)
+
+        await ctx.send(
+            f'{len(self.store)} reports stored, {len(self._pending_updates)} updates pending\n'
+            f'Backlog: {self.rr.backlog} (max {self.rr.max_queue_depth}), {self.rr.dropped} dropped, workers: {worker_depths}\n'
+            f'{pipeline["processed"]} reports handled, {pipeline["failed"]} failed, '
+            f'whisper to Discord: {pipeline_average:.2f}s average, {pipeline["latency_max"]:.2f}s max\n'
+            f'{stats["updates"]} updates applied as {stats["edits"]} edits and {stats["reposts"]} reposts, {self.calls_saved} API calls saved\n'
+            f'Update latency: {average:.1f}s average, {stats["latency_max"]:.1f}s max\n'
+            f'{self.conf_writer.summary()}'
+        )
+
+    @reports_cmd.command(name='twitch')
+    @mod.is_owner()
+    async def twitch_cmd(self, ctx, output: str = 'summary'):
+        irc = self.ml.metrics
+        pubsub = self.rr.metrics
+
+        if output == 'json':
+            data = json.dumps({'irc': irc.to_dict(), 'pubsub': pubsub.to_dict()}, indent=2)
+            await ctx.send(file=discord.File(io.BytesIO(data.encode()), filename='twitch_metrics.json'))
+            return
+
+        queue_depths = ', '.join(f'{shard.queue_depth} (max {shard.max_queue_depth})' for shard in self.ml.shards)
+
+        await ctx.send_paginated(
+            f'**IRC** ({len(self.ml.shards)} connections, dispatch queues: {queue_depths})\n{irc.summary() or "Nothing yet"}\n\n'
+            f'**PubSub** ({len(self.rr.shards)} connections)\n{pubsub.summary() or "Nothing yet"}'
+        )
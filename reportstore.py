@@ -0,0 +1,173 @@
+# Persistent report storage for the report module
+#
+# Every change to a report is appended to a journal as one JSON line, so filing a report costs one
+# small write no matter how many came before. Every so often the journal is folded into a snapshot
+# and emptied, and reports older than the retention period are moved out to an archive file.
+# Loading reads the snapshot and replays the (short) journal on top of it.
+
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+
+from .chatlog import Message
+
+
+log = logging.getLogger('reportstore')
+
+
+Report = namedtuple('Report', 'message reasons discord_id')
+
+
+def encode_report(message_id, report):
+    message = report.message
+    return json.dumps({
+        'id': message_id,
+        'message': [message.id, message.sender, message.content, message.timestamp],
+        'reasons': report.reasons,
+        'discord_id': report.discord_id,
+    }, separators=(',', ':')) + '\n'
+
+
+def decode_report(line):
+    data = json.loads(line)
+    return data['id'], Report(Message(*data['message']), data['reasons'], data['discord_id'])
+
+
+class ReportStore:
+    def __init__(self, directory, compact_every=1000, retention=180 * 24 * 3600):
+        self.directory = directory
+        self.compact_every = compact_every
+        self.retention = retention
+
+        self.snapshot_path = os.path.join(directory, 'reports.snapshot')
+        self.journal_path = os.path.join(directory, 'reports.journal')
+        self.archive_path = os.path.join(directory, 'reports.archive')
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.reports = {}
+        self._journal_entries = 0
+        self._load()
+
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _read_lines(self, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+
+                    try:
+                        yield decode_report(line)
+                    except (ValueError, KeyError, TypeError):
+                        # Most likely a torn last line from a crash, cut off by _trim_journal before appending again
+                        log.warning(f'Skipping unreadable line {line_number} in {path}')
+
+        except FileNotFoundError:
+            return
+
+    def _load(self):
+        start = time.monotonic()
+
+        for message_id, report in self._read_lines(self.snapshot_path):
+            self.reports[message_id] = report
+
+        for message_id, report in self._read_lines(self.journal_path):
+            self.reports[message_id] = report
+            self._journal_entries += 1
+
+        self._trim_journal()
+
+        log.info(f'Loaded {len(self.reports)} reports ({self._journal_entries} journal entries) in {time.monotonic() - start:.3f}s')
+
+    def _trim_journal(self):
+        # A write torn by a crash leaves a line without its newline at the end. Appending to that would glue
+        # the next report onto it and lose both, so it's cut back to the last complete line.
+        try:
+            f = open(self.journal_path, 'rb+')
+        except FileNotFoundError:
+            return
+
+        with f:
+            end = f.seek(0, os.SEEK_END)
+            size = end
+
+            while size > 0:
+                start = max(0, size - 4096)
+                f.seek(start)
+                newline = f.read(size - start).rfind(b'\n')
+
+                if newline != -1:
+                    size = start + newline + 1
+                    break
+
+                size = start
+
+            if size != end:
+                log.warning(f'Cutting {end - size} bytes of torn write off the end of {self.journal_path}')
+                f.truncate(size)
+
+    def __contains__(self, message_id):
+        return message_id in self.reports
+
+    def __len__(self):
+        return len(self.reports)
+
+    def get(self, message_id):
+        return self.reports.get(message_id)
+
+    def put(self, message_id, report):
+        self.reports[message_id] = report
+
+        self._journal.write(encode_report(message_id, report))
+        self._journal.flush()
+        self._journal_entries += 1
+
+        if self._journal_entries >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        # Reports about messages older than the retention period go to the archive, the rest into a fresh snapshot
+        cutoff = (time.time() - self.retention) * 1000
+        expired = {message_id: report for message_id, report in self.reports.items() if report.message.timestamp < cutoff}
+
+        if expired:
+            with open(self.archive_path, 'a', encoding='utf-8') as f:
+                f.writelines(encode_report(message_id, report) for message_id, report in expired.items())
+                f.flush()
+                os.fsync(f.fileno())
+
+            for message_id in expired:
+                del self.reports[message_id]
+
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(encode_report(message_id, report) for message_id, report in self.reports.items())
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self.snapshot_path)
+
+        # Only safe to drop the journal once the snapshot that contains it is in place
+        self._journal.close()
+        self._journal = open(self.journal_path, 'w', encoding='utf-8')
+        self._journal_entries = 0
+
+        log.debug(f'Compacted reports, {len(self.reports)} kept, {len(expired)} archived')
+
+    def import_reports(self, reports):
+        # One-off migration from reports kept in the module config
+        for message_id, report in reports.items():
+            message = Message(*report.message)
+            self.reports[message_id] = Report(message, report.reasons, report.discord_id)
+
+        self.compact()
+
+    def close(self):
+        if self._journal_entries:
+            self.compact()
+
+        self._journal.close()
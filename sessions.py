@@ -0,0 +1,68 @@
+# One aiohttp session shared by every module in the set
+#
+# Modules acquire it on load and release it on unload, the last one out closes it and waits for the
+# connections to actually go away. Sharing one connector means kept-alive connections, the DNS cache
+# and per-host limits apply across the Twitch sockets, AniList and the events feed alike, and reloading
+# a module doesn't leave its sockets behind.
+
+import asyncio
+import logging
+
+import aiohttp
+
+try:
+    # Resolves without a thread per lookup, only if aiodns is installed
+    import aiodns
+    from aiohttp.resolver import AsyncResolver
+except ImportError:
+    AsyncResolver = None
+
+
+log = logging.getLogger('sessions')
+
+
+class SharedSession:
+    def __init__(self, limit=100, limit_per_host=20, dns_ttl=300, keepalive_timeout=60):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+
+        self.session = None
+        self.users = 0
+
+    def _connector(self):
+        return aiohttp.TCPConnector(
+            limit=self.limit,
+            # Websockets hold on to their connection, so this also caps the Twitch connections per host
+            limit_per_host=self.limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+            resolver=AsyncResolver() if AsyncResolver is not None else None,
+            enable_cleanup_closed=True,
+        )
+
+    def acquire(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(connector=self._connector())
+            log.info('Session opened')
+
+        self.users += 1
+        return self.session
+
+    async def release(self):
+        self.users -= 1
+
+        if self.users > 0 or self.session is None:
+            return
+
+        session, self.session = self.session, None
+        await session.close()
+
+        # Gives SSL transports a moment to finish closing, or they get reported as unclosed
+        await asyncio.sleep(0.25)
+        log.info('Session closed')
+
+
+shared = SharedSession()
@@ -1,35 +1,314 @@
+import asyncio
+import time
+from collections import OrderedDict
+
 import discord
 
 # from ...common import *
 from ... import module as mod
+from .confwriter import ConfigWriter
+
+
+log = mod.get_logger()
+
+
+# Members that had to be fetched over REST, kept around so people toggling a reaction only cost one fetch
+MEMBER_CACHE_SIZE = 1000
+
+# Role changes found by a reconciliation pass are handed to the workers this many at a time
+RECONCILE_BATCH_SIZE = 50
+# Posts whose reactions are read at the same time
+RECONCILE_CONCURRENCY = 4
+
+
+class RoleUpdateQueue:
+    # A new sign-up post gets hundreds of reactions within seconds, and people like to click them more than once.
+    # Requests are coalesced per (member, role): an add and a remove that are both still waiting cancel out,
+    # otherwise only the newest one is applied. A fixed number of workers apply them, retrying when rate limited.
+
+    def __init__(self, workers=4, max_attempts=5):
+        self.max_attempts = max_attempts
+
+        # (guild id, member id, role id) -> [first requested add/remove, latest requested add/remove, member if known]
+        self.pending = {}
+        # Keys that are waiting in the queue or being worked on, so each key is only handled by one worker at a time
+        self.scheduled = set()
+        self.queue = asyncio.Queue()
+        self.members = OrderedDict()
+
+        self.stats = {'requested': 0, 'coalesced': 0, 'cancelled': 0, 'applied': 0, 'retried': 0, 'failed': 0, 'fetched': 0}
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(max(1, workers))]
+
+    def request(self, guild, role, member_id, add, member=None):
+        key = guild.id, member_id, role.id
+        self.stats['requested'] += 1
+
+        if key in self.pending:
+            self.stats['coalesced'] += 1
+            self.pending[key][1] = add
+            self.pending[key][2] = self.pending[key][2] or member
+        else:
+            self.pending[key] = [add, add, member]
+
+        if key not in self.scheduled:
+            self.scheduled.add(key)
+            self.queue.put_nowait((guild, role, member_id))
+
+    async def _worker(self):
+        while True:
+            guild, role, member_id = await self.queue.get()
+            key = guild.id, member_id, role.id
+
+            try:
+                # More requests for the same key can come in while we're applying one
+                while key in self.pending:
+                    first, add, member = self.pending.pop(key)
+
+                    if first != add:
+                        # Reacted and unreacted (or the other way around) before we got to it, nothing changes
+                        self.stats['cancelled'] += 1
+                        continue
+
+                    try:
+                        await self._apply(guild, role, member_id, add, member)
+                    except Exception:
+                        self.stats['failed'] += 1
+                        log.exception(f'Failed to update role {role} for member {member_id}')
+
+            finally:
+                self.scheduled.discard(key)
+                self.queue.task_done()
+
+    async def resolve_member(self, guild, member_id):
+        member = guild.get_member(member_id)
+        if member is not None:
+            return member
+
+        key = guild.id, member_id
+        if key in self.members:
+            self.members.move_to_end(key)
+            return self.members[key]
+
+        member = await guild.fetch_member(member_id)
+        self.stats['fetched'] += 1
+
+        self.members[key] = member
+        while len(self.members) > MEMBER_CACHE_SIZE:
+            self.members.popitem(last=False)
+
+        return member
+
+    async def _apply(self, guild, role, member_id, add, member):
+        backoff = mod.ExponentialBackoff()
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                if member is None:
+                    member = await self.resolve_member(guild, member_id)
+
+                if add:
+                    await member.add_roles(role, reason='Requested through bot')
+                else:
+                    await member.remove_roles(role, reason='Requested through bot')
+
+                self.stats['applied'] += 1
+                return
+
+            except discord.NotFound:
+                # Left the server in the meantime
+                self.members.pop((guild.id, member_id), None)
+                return
+
+            except discord.RateLimited as e:
+                # discord.py only gives up on a rate limit when the wait would be too long
+                delay = e.retry_after
+
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    raise
+
+                delay = backoff.delay()
+
+            if attempt < self.max_attempts:
+                self.stats['retried'] += 1
+                log.warning(f'Rate limited updating role {role} for {member_id}, retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+
+        self.stats['failed'] += 1
+        log.error(f'Giving up on updating role {role} for {member_id} after {self.max_attempts} attempts')
+
+    def cancel(self):
+        for worker in self.workers:
+            worker.cancel()
 
 
 class SignupModule(mod.Module):
     class Config(mod.Config):
         posts: dict[tuple[int, int], int] = {}
+        role_workers: int = 4
+        reconcile_on_load: bool = True
+        # Also take the role away from people who have it without having reacted, which includes anyone
+        # given the role by hand. Off by default so a reload never takes roles away in bulk.
+        reconcile_removals: bool = False
+
+    async def on_load(self):
+        self.conf_writer = ConfigWriter(self.conf)
+        self.roles = RoleUpdateQueue(self.conf.role_workers)
+        self.reconcile_task = None
+        # One set per running reconciliation pass, of the (member id, role id) that got live reactions meanwhile
+        self.live_changes = []
+
+        if self.conf.reconcile_on_load:
+            self.reconcile_task = asyncio.create_task(self.reconcile_after_ready())
+
+    async def on_unload(self):
+        if self.reconcile_task is not None:
+            self.reconcile_task.cancel()
+
+        self.roles.cancel()
+        await self.conf_writer.close()
+
+    async def reconcile_after_ready(self):
+        await self.bot.wait_until_ready()
+        logged = 0
+
+        async def progress(done, total):
+            # Every tenth of the way is enough for the log
+            nonlocal logged
+            if done == total or done - logged >= total / 10:
+                logged = done
+                log.info(f'Sign-up reconciliation: applied {done} of {total} role changes')
+
+        try:
+            await self.reconcile(progress)
+        except Exception:
+            log.exception('Sign-up reconciliation failed')
+
+    async def read_reactors(self, channel_id, message_id):
+        # Everyone who reacted to the post with any emoji, same as the live handlers count it. None if the post is gone.
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            return None
+
+        try:
+            message = await channel.fetch_message(message_id)
+        except discord.NotFound:
+            return None
+
+        reactors = set()
+
+        for reaction in message.reactions:
+            async for user in reaction.users(limit=None):
+                reactors.add(user.id)
+
+        reactors.discard(self.bot.user.id)
+        return reactors
+
+    async def reconcile(self, progress=None):
+        # Live reactions keep being applied while a pass runs. Whoever reacts or unreacts in the meantime
+        # has a newer answer than what the pass read, so those are left out of its changes.
+        touched = set()
+        self.live_changes.append(touched)
+
+        try:
+            return await self._reconcile(touched, progress)
+        finally:
+            self.live_changes.remove(touched)
+
+    async def _reconcile(self, touched, progress):
+        # Catches up on reactions that came and went while we weren't around.
+        # Reactions are read for all posts first, then only the difference to who has the role is applied.
+        start = time.monotonic()
+        slots = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+
+        async def read(key):
+            async with slots:
+                return await self.read_reactors(*key)
+
+        posts = list(self.conf.posts.items())
+        results = await asyncio.gather(*(read(key) for key, _ in posts))
+
+        # Several posts can hand out the same role, reacting to any of them counts
+        wanted = {}
+        # Roles with a post we couldn't read, nobody loses those since we don't know who reacted there
+        incomplete = set()
+
+        for ((channel_id, message_id), role_id), reactors in zip(posts, results):
+            channel = self.bot.get_channel(channel_id)
+            role = channel.guild.get_role(role_id) if channel is not None else None
+
+            if role is None:
+                log.warning(f'Role {role_id} for sign-up post {message_id} is gone, skipping it')
+                continue
+
+            if reactors is None:
+                log.warning(f'Could not read reactions on sign-up post {message_id} in {channel_id}, skipping it')
+                incomplete.add(role)
+                continue
+
+            wanted.setdefault(role, set()).update(reactors)
+
+        changes = []
+        for role, reactors in wanted.items():
+            guild = role.guild
+
+            # Role holders come from the member cache, which has to be complete for this to mean anything
+            if not guild.chunked:
+                await guild.chunk()
+
+            holders = {member.id for member in role.members}
+            changes += [(role, member_id, True) for member_id in reactors - holders if guild.get_member(member_id) is not None]
+
+            if self.conf.reconcile_removals and role not in incomplete:
+                changes += [(role, member_id, False) for member_id in holders - reactors]
+
+        log.info(f'Reconciling {len(posts)} sign-up posts: {len(changes)} role changes, read in {time.monotonic() - start:.1f}s')
+
+        for i in range(0, len(changes), RECONCILE_BATCH_SIZE):
+            for role, member_id, add in changes[i:i + RECONCILE_BATCH_SIZE]:
+                if (member_id, role.id) not in touched:
+                    self.roles.request(role.guild, role, member_id, add)
+
+            # Let the workers get through this batch first, live reactions keep being handled in between
+            await self.roles.queue.join()
+
+            done = min(i + RECONCILE_BATCH_SIZE, len(changes))
+            if progress is not None:
+                await progress(done, len(changes))
+
+        log.info(f'Sign-up reconciliation done in {time.monotonic() - start:.1f}s, {len(touched)} changed live in the meantime')
+        return len(changes)
+
+    def _signup_role(self, event):
+        # The role for a reaction on one of our posts, or None if the reaction isn't one to act on
+        if (event.channel_id, event.message_id) not in self.conf.posts or event.user_id == self.bot.user.id:
+            return None
+
+        channel = self.bot.get_channel(event.channel_id)
+        role = channel.guild.get_role(self.conf.posts[event.channel_id, event.message_id])
+
+        if role is not None:
+            for touched in self.live_changes:
+                touched.add((event.user_id, role.id))
+
+        return role
 
     @mod.Module.listener()
     async def on_raw_reaction_add(self, event):
-        if (event.channel_id, event.message_id) in self.conf.posts and event.user_id != self.bot.user.id:
-            channel = self.bot.get_channel(event.channel_id)
-            role = channel.guild.get_role(self.conf.posts[event.channel_id, event.message_id])
-
-            await event.member.add_roles(role, reason='Requested through bot')
+        if (role := self._signup_role(event)) is not None:
+            self.roles.request(role.guild, role, event.user_id, True, member=event.member)
 
     @mod.Module.listener()
     async def on_raw_reaction_remove(self, event):
-        if (event.channel_id, event.message_id) in self.conf.posts and event.user_id != self.bot.user.id:
-            channel = self.bot.get_channel(event.channel_id)
-            role = channel.guild.get_role(self.conf.posts[event.channel_id, event.message_id])
-            member = await channel.guild.fetch_member(event.user_id)
-
-            await member.remove_roles(role, reason='Requested through bot')
+        if (role := self._signup_role(event)) is not None:
+            self.roles.request(role.guild, role, event.user_id, False)
 
     @mod.Module.listener()
     async def on_raw_message_delete(self, event):
         if (event.channel_id, event.message_id) in self.conf.posts:
             del self.conf.posts[event.channel_id, event.message_id]
-            await self.conf.commit()
+            # Bulk deletes come in one event per message, they end up in one commit
+            self.conf_writer.changed()
 
     @mod.group(name='signup', invoke_without_command=True)
     @mod.is_owner()
@@ -40,12 +319,30 @@ class SignupModule(mod.Module):
             role = channel.guild.get_role(role_id)
             messages.append((role, channel))
 
-        await ctx.send_paginated('Active sign-up posts:\n' + '\n'.join(f' - {role} in #{channel}' for role, channel in messages))
+        stats = self.roles.stats
+        summary = (
+            f'{stats["requested"]} role requests, {stats["coalesced"]} coalesced, {stats["cancelled"]} cancelled out, '
+            f'{stats["applied"]} applied, {stats["retried"]} retries, {stats["failed"]} failed, {len(self.roles.pending)} pending\n'
+            f'{self.conf_writer.summary()}\n'
+        )
+
+        await ctx.send_paginated(summary + 'Active sign-up posts:\n' + '\n'.join(f' - {role} in #{channel}' for role, channel in messages))
+
+    @signup_cmd.command(name='reconcile')
+    @mod.is_owner()
+    async def reconcile_cmd(self, ctx):
+        status = await ctx.send('Reading sign-up reactions...')
+
+        async def progress(done, total):
+            await status.edit(content=f'Applied {done} of {total} role changes...')
+
+        total = await self.reconcile(progress)
+        await status.edit(content=f'Reconciled {len(self.conf.posts)} sign-up posts, {total} role changes.')
 
     @signup_cmd.command(name='create')
     @mod.is_superuser()
     async def create_cmd(self, ctx, role: discord.Role, emoji: str, *, message):
         msg = await ctx.send(embed=discord.Embed(color=getattr(ctx.me, 'color', 0), title=f'{role}', description=f'{message}\n\n*React with {emoji} to receive this role.*'))
         self.conf.posts[msg.channel.id, msg.id] = role.id
-        await self.conf.commit()
+        await self.conf_writer.commit()
         await msg.add_reaction(emoji)
@@ -9,13 +9,23 @@ import json
 import logging
 import re
 import time
-from collections import namedtuple
+import uuid
+from collections import Counter, deque, namedtuple
+from collections.abc import Mapping
 
 import aiohttp
 from discord.backoff import ExponentialBackoff
 
 from gs6ex.common import Obj
 
+from .metrics import BACKOFF_BUCKETS, LATENCY_BUCKETS, Histogram, RateMeter
+from .ratelimit import TokenBucket
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 irc_log = logging.getLogger('twitch.irc')
 pubsub_log = logging.getLogger('twitch.pubsub')
@@ -95,37 +105,491 @@ def parse_irc_message(string):
     return IRCMessage(tags, name, nick, host, command, params)
 
 
+# Lazy parsing: keep the raw line around and only slice out what actually gets read.
+# Most consumers look at the command and maybe two tags, so decoding everything up front is wasted work.
+
+def unescape_tag(value):
+    if '\\' not in value:
+        return value
+
+    return escape_re.sub(escape_repl, value)
+
+
+class IRCTags(Mapping):
+    __slots__ = ('_line', '_start', '_end', '_cache')
+
+    def __init__(self, line, start, end):
+        self._line = line
+        self._start = start
+        self._end = end
+        self._cache = None
+
+    def _find(self, key):
+        line = self._line
+        start = self._start
+        end = self._end
+        needle = key + '='
+        pos = start
+
+        while True:
+            pos = line.find(needle, pos, end)
+            if pos == -1:
+                return None
+
+            # Make sure we matched a whole key, not the tail of a longer one
+            if pos == start or line[pos - 1] == ';':
+                break
+
+            pos += 1
+
+        value_start = pos + len(needle)
+        value_end = line.find(';', value_start, end)
+        if value_end == -1:
+            value_end = end
+
+        return line[value_start:value_end]
+
+    def __getitem__(self, key):
+        cache = self._cache
+        if cache is not None and key in cache:
+            return cache[key]
+
+        value = self._find(key)
+        if value is None:
+            raise KeyError(key)
+
+        value = unescape_tag(value)
+
+        if cache is None:
+            cache = self._cache = {}
+
+        cache[key] = value
+        return value
+
+    def _decode_all(self):
+        line = self._line
+        end = self._end
+        pos = self._start
+        tags = {}
+
+        while pos < end:
+            equals = line.index('=', pos)
+            value_end = try_index(line, ';', equals + 1, end) or end
+            tags[line[pos:equals]] = unescape_tag(line[equals + 1:value_end])
+            pos = value_end + 1
+
+        self._cache = tags
+        return tags
+
+    def __iter__(self):
+        return iter(self._decode_all())
+
+    def __len__(self):
+        return len(self._decode_all())
+
+    def __repr__(self):
+        return f'IRCTags({self._decode_all()!r})'
+
+
+class LazyIRCMessage:
+    __slots__ = ('line', 'command', '_tags_end', '_prefix_start', '_prefix_end', '_params_start', '_tags', '_prefix', '_params')
+
+    def __init__(self, line):
+        line = line.strip()
+        pos = 0
+        tags_end = 0
+
+        if line[pos] == '@':
+            tags_end = line.index(' ', pos)
+            pos = tags_end
+
+            while line[pos] == ' ':
+                pos += 1
+
+        prefix_start = prefix_end = pos
+
+        if line[pos] == ':':
+            prefix_start = pos + 1
+            prefix_end = line.index(' ', prefix_start)
+            pos = prefix_end
+
+            while line[pos] == ' ':
+                pos += 1
+
+        command_end = line.index(' ', pos)
+
+        self.line = line
+        self.command = line[pos:command_end]
+        self._tags_end = tags_end
+        self._prefix_start = prefix_start
+        self._prefix_end = prefix_end
+        self._params_start = command_end
+        self._tags = None
+        self._prefix = None
+        self._params = None
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = IRCTags(self.line, 1, self._tags_end) if self._tags_end else IRCTags('', 0, 0)
+
+        return self._tags
+
+    def _split_prefix(self):
+        if self._prefix is None:
+            prefix = self.line[self._prefix_start:self._prefix_end]
+
+            if '!' in prefix:
+                nick, rest = prefix.split('!', maxsplit=1)
+                name, host = rest.split('@', maxsplit=1)
+                self._prefix = (name, nick, host)
+            else:
+                self._prefix = (None, None, prefix or None)
+
+        return self._prefix
+
+    @property
+    def name(self):
+        return self._split_prefix()[0]
+
+    @property
+    def nick(self):
+        return self._split_prefix()[1]
+
+    @property
+    def host(self):
+        return self._split_prefix()[2]
+
+    @property
+    def params(self):
+        if self._params is None:
+            line = self.line
+            pos = self._params_start
+
+            while line[pos] == ' ':
+                pos += 1
+
+            params, *trailing = line[pos:].split(':', maxsplit=1)
+            self._params = [*params.split(), *trailing]
+
+        return self._params
+
+    def __repr__(self):
+        return f'LazyIRCMessage({self.line!r})'
+
+
+def parse_irc_message_lazy(string):
+    return LazyIRCMessage(string)
+
+
 # Twitch Clients
 
 
 loop = asyncio.get_event_loop()
 
 
+IRC_URL = 'wss://irc-ws.chat.twitch.tv:443'
+PUBSUB_URL = 'wss://pubsub-edge.twitch.tv'
+
+
 class WebSocketError(Exception): pass
+class PubSubError(Exception): pass
 
 
-class TwitchIRCSocket:
+# Metrics, the pieces are in metrics.py
+
+class SocketMetrics:
     def __init__(self):
-        self._session = None
+        self.started = time.monotonic()
+        self.counters = Counter()
+        self.histograms = {}
+        self.rates = {}
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(bounds)
+
+        return self.histograms[name]
+
+    def rate(self, name):
+        if name not in self.rates:
+            self.rates[name] = RateMeter()
+
+        return self.rates[name]
+
+    @classmethod
+    def merged(cls, metrics):
+        # For pools, adds up the numbers of all their sockets
+        result = cls()
+        result.started = min((m.started for m in metrics), default=result.started)
+
+        for m in metrics:
+            result.counters.update(m.counters)
+
+            for name, histogram in m.histograms.items():
+                result.histogram(name, histogram.bounds).merge(histogram)
+
+            for name, rate in m.rates.items():
+                result.rate(name).histogram.merge(rate.histogram)
+
+        return result
+
+    def to_dict(self):
+        uptime = time.monotonic() - self.started
+
+        return {
+            'uptime': uptime,
+            'counters': dict(self.counters),
+            'average_rates': {name: n / uptime for name, n in self.counters.items()} if uptime else {},
+            'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            'rates': {name: rate.histogram.to_dict() for name, rate in self.rates.items()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def summary(self):
+        # A few lines for humans, the JSON has everything
+        lines = []
+
+        if self.counters:
+            lines.append(', '.join(f'{name}: {n:g}' for name, n in sorted(self.counters.items())))
+
+        for name, rate in sorted(self.rates.items()):
+            h = rate.histogram
+            if h.count:
+                lines.append(f'{name}/s: p50 {h.percentile(50)}, p99 {h.percentile(99)}, max {h.max}')
+
+        for name, h in sorted(self.histograms.items()):
+            lines.append(f'{name}: {h.count} samples, mean {h.mean * 1000:.3f}ms, p50 {h.percentile(50) * 1000:.3f}ms, p99 {h.percentile(99) * 1000:.3f}ms, max {h.max * 1000:.3f}ms')
+
+        return '\n'.join(lines)
+
+
+# (commands, period in seconds) per command class, for a regular non-verified account.
+# Anything not listed here is sent as fast as the socket allows.
+IRC_RATE_LIMITS = {
+    'PASS': (20, 10),
+    'JOIN': (20, 10),
+    'PRIVMSG': (20, 30),
+}
+
+
+# What to do with an incoming line when the dispatch queue is full.
+# 'block' stops reading from the socket until a worker catches up. PINGs in the frame being read are still
+# answered first, but one in a later frame waits, so Twitch may drop the connection if the workers stay behind.
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+
+class TwitchIRCSocket:
+    def __init__(self, lazy_parsing=False, dispatch_workers=0, queue_size=1000, overflow='drop-oldest', rate_limits=IRC_RATE_LIMITS, max_frame_size=4096, url=IRC_URL, session=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}')
+
+        self.url = url
+        # A session passed in is shared with others and left open, one we make ourselves is closed with the socket
+        self._session = session
+        self._owns_session = session is None
         self._ws = None
         self.closed = False
         self.messages = {}
+        self.parse_message = parse_irc_message_lazy if lazy_parsing else parse_irc_message
+
+        # With dispatch_workers=0 handlers run inline in the read loop, like they always did
+        self.dispatch_workers = dispatch_workers
+        self.overflow = overflow
+        self._queue = asyncio.Queue(maxsize=queue_size) if dispatch_workers > 0 else None
+        self._workers = []
+        self.dropped = 0
+        self.max_queue_depth = 0
+
+        # Outgoing lines wait here until their command class has budget, then go out batched into as few frames as possible
+        self.rate_limits = {command: TokenBucket(*limit) for command, limit in rate_limits.items()}
+        self.max_frame_size = max_frame_size
+        self._outbox = deque()
+        self._outbox_ready = asyncio.Event()
+        self._writer_task = None
+
+        # The ones used for every line are looked up once here
+        self.metrics = SocketMetrics()
+        self._counters = self.metrics.counters
+        self._line_rate = self.metrics.rate('lines')
+        self._parse_time = self.metrics.histogram('parse_time')
+        self._handler_time = self.metrics.histogram('handler_time')
+        self._queue_wait = self.metrics.histogram('queue_wait')
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
     
-    async def send(self, s):
+    def send(self, s):
+        # Returns a future that resolves once the line has actually been written to the socket
+        future = asyncio.get_running_loop().create_future()
+        self._outbox.append((s, future))
+        self._outbox_ready.set()
+        return future
+
+    async def _send_now(self, s):
         irc_log.debug(f'> {s}')
         await self._ws.send_str(s + '\r\n')
 
+    def _take_batch(self):
+        lines = []
+        futures = []
+        size = 0
+
+        while self._outbox:
+            line, future = self._outbox[0]
+
+            if future.done():
+                self._outbox.popleft()
+                continue
+
+            if lines and size + len(line) + 2 > self.max_frame_size:
+                break
+
+            bucket = self.rate_limits.get(line.split(' ', maxsplit=1)[0])
+            if bucket is not None and not bucket.try_take():
+                return lines, futures, bucket.delay()
+
+            self._outbox.popleft()
+            lines.append(line)
+            futures.append(future)
+            size += len(line) + 2
+
+        return lines, futures, 0
+
+    async def _writer(self):
+        while True:
+            if not self._outbox:
+                self._outbox_ready.clear()
+                await self._outbox_ready.wait()
+
+            lines, futures, delay = self._take_batch()
+
+            if lines:
+                for line in lines:
+                    irc_log.debug(f'> {line}')
+
+                try:
+                    await self._ws.send_str('\r\n'.join(lines) + '\r\n')
+
+                except asyncio.CancelledError as e:
+                    self._fail_futures(futures, e)
+                    raise
+
+                except Exception as e:
+                    # The reader will notice the broken connection and reconnect
+                    irc_log.debug('Write failed', exc_info=True)
+                    self._fail_futures(futures, e)
+                    return
+
+                self._counters['sent_frames'] += 1
+                self._counters['sent_lines'] += len(lines)
+
+                for future in futures:
+                    if not future.done():
+                        future.set_result(None)
+
+            if delay:
+                await asyncio.sleep(delay)
+
+    def _fail_futures(self, futures, exc):
+        for future in futures:
+            if not future.done():
+                future.set_exception(WebSocketError(f'Line was not sent: {exc!r}') if isinstance(exc, asyncio.CancelledError) else exc)
+                # Nobody is obliged to await a send, so don't complain about unretrieved exceptions
+                future.exception()
+
+    def _start_writer(self):
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def _stop_writer(self):
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+
+        # Whatever was still queued belonged to the old connection, on_connect will redo login and joins
+        self._fail_futures([future for _, future in self._outbox], WebSocketError('Connection lost'))
+        self._outbox.clear()
+
     async def _on_message(self, msg):
-        for line in msg.data.split('\r\n'):
-            if len(line) == 0: continue
-            irc_log.debug(f'< {line}')
+        lines = [line for line in msg.data.split('\r\n') if line]
+        self._counters['frames'] += 1
+        self._counters['lines'] += len(lines)
+        self._line_rate.add(len(lines))
+
+        # Answered before anything in the frame is handed on, so a full dispatch queue can't hold them up
+        for line in lines:
+            if line == 'PING :tmi.twitch.tv':
+                irc_log.debug(f'< {line}')
+                await self._send_now('PONG :tmi.twitch.tv')
 
+        for line in lines:
             if line == 'PING :tmi.twitch.tv':
-                await self.send('PONG :tmi.twitch.tv')
-            
+                continue
+
+            irc_log.debug(f'< {line}')
+
+            if self._queue is not None:
+                await self._enqueue(line)
+
             else:
-                msg = parse_irc_message(line)
-                await self.on_message(msg)
+                await self._dispatch(line)
+
+    async def _dispatch(self, line):
+        start = time.perf_counter()
+        msg = self.parse_message(line)
+        parsed = time.perf_counter()
+
+        await self.on_message(msg)
+
+        self._parse_time.record(parsed - start)
+        self._handler_time.record(time.perf_counter() - parsed)
+
+    async def _enqueue(self, line):
+        queue = self._queue
+
+        if queue.full():
+            if self.overflow == 'drop-newest':
+                self.dropped += 1
+                self._counters['dropped'] += 1
+                irc_log.debug(f'Dispatch queue full, dropped {line}')
+                return
+
+            elif self.overflow == 'drop-oldest':
+                dropped_line, _ = queue.get_nowait()
+                queue.task_done()
+                self.dropped += 1
+                self._counters['dropped'] += 1
+                irc_log.debug(f'Dispatch queue full, dropped {dropped_line}')
+
+        await queue.put((line, time.perf_counter()))
+        self.max_queue_depth = max(self.max_queue_depth, queue.qsize())
+
+    async def _dispatch_worker(self):
+        while True:
+            line, queued_at = await self._queue.get()
+            self._queue_wait.record(time.perf_counter() - queued_at)
+
+            try:
+                await self._dispatch(line)
+
+            except Exception:
+                irc_log.exception(f'Failed to handle {line}')
+
+            finally:
+                self._queue.task_done()
+
+    def _start_workers(self):
+        if self._queue is not None and not self._workers:
+            self._workers = [asyncio.create_task(self._dispatch_worker()) for _ in range(self.dispatch_workers)]
+
+    def _stop_workers(self):
+        for worker in self._workers:
+            worker.cancel()
+
+        self._workers = []
 
     async def on_message(self, msg):
         pass
@@ -133,17 +597,24 @@ class TwitchIRCSocket:
     async def on_connect(self):
         pass
 
+    async def on_disconnect(self):
+        pass
+
     async def ensure_session(self):
         if not self._session:
             self._session = aiohttp.ClientSession()
+            self._owns_session = True
 
     async def connect(self):
         backoff = ExponentialBackoff()
+        self._start_workers()
         
         while not self.closed:
             try:
                 await self.ensure_session()
-                self._ws = await self._session.ws_connect('wss://irc-ws.chat.twitch.tv:443')
+                self._ws = await self._session.ws_connect(self.url)
+                self._counters['connects'] += 1
+                self._start_writer()
 
                 await self.on_connect()
                 
@@ -155,45 +626,323 @@ class TwitchIRCSocket:
                         raise WebSocketError
 
             except (OSError, aiohttp.ClientError, asyncio.TimeoutError, WebSocketError):
-                irc_log.error(exc_info=True)
-                
-                if self.closed:
-                    return
+                irc_log.error('IRC connection failed', exc_info=True)
+                self._counters['connection_errors'] += 1
+                delay = backoff.delay()
+
+            else:
+                delay = 0
+
+            finally:
+                self._stop_writer()
+
+            await self.on_disconnect()
 
-                irc_log.info('Reconnecting to IRC')
-                await asyncio.sleep(backoff.delay())
+            if self.closed:
+                return
+
+            irc_log.info('Reconnecting to IRC')
+            self._record_reconnect(delay)
+            await asyncio.sleep(delay)
     
-    def close(self):
+    def _record_reconnect(self, delay):
+        self._counters['reconnects'] += 1
+        self._counters['backoff_seconds'] += delay
+        self.metrics.histogram('backoff', BACKOFF_BUCKETS).record(delay)
+
+    async def close(self):
         self.closed = True
+        self._stop_workers()
+        self._stop_writer()
+
+        if self._ws:
+            await self._ws.close()
+        if self._session and self._owns_session:
+            await self._session.close()
+
+    # These don't wait for each other, so several calls in a row end up in the same frame.
+    # Await the returned futures to know when the lines were written.
+
+    def login(self, name, token):
+        return asyncio.gather(
+            self.send(f'PASS oauth:{token}'),
+            self.send(f'NICK {name}'),
+        )
 
-        asyncio.create_task(self._ws.close())
-        asyncio.create_task(self._session.close())
+    def request_capabilities(self, *caps):
+        return self.send(f'CAP REQ :{" ".join(caps)}')
 
-    async def login(self, name, token):
-        await self.send(f'PASS oauth:{token}')
-        await self.send(f'NICK {name}')
+    def join_channel(self, channel_name):
+        return self.send(f'JOIN #{channel_name}')
 
-    async def request_capabilities(self, *caps):
-        await self.send(f'CAP REQ :{" ".join(caps)}')
+    def part_channel(self, channel_name):
+        return self.send(f'PART #{channel_name}')
+
+
+class TwitchIRCShard(TwitchIRCSocket):
+    def __init__(self, pool, index, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.pool = pool
+        self.index = index
+        self.channels = set()
+        self.connected = False
+
+    async def on_connect(self):
+        self.connected = True
+        await self.pool.on_shard_connect(self)
+
+    async def on_disconnect(self):
+        self.connected = False
+        await self.pool.on_shard_disconnect(self)
+
+    async def on_message(self, msg):
+        await self.pool.on_shard_message(self, msg)
+
+
+# How long a channel being moved between shards waits for the new shard's JOIN before parting the old one anyway
+MOVE_JOIN_TIMEOUT = 60
+
+
+class TwitchIRCPool:
+    # Spreads channels over several IRC connections.
+    # Every shard has its own socket, writer and JOIN budget, and reconnects on its own.
+
+    def __init__(self, user_name, oauth_token, capabilities=(), shard_count=1, max_channels_per_shard=100, **socket_kwargs):
+        self.user_name = user_name
+        self.oauth_token = oauth_token
+        self.capabilities = capabilities
+        self.max_channels_per_shard = max_channels_per_shard
+        self.shards = [TwitchIRCShard(self, i, **socket_kwargs) for i in range(shard_count)]
+        self.assignments = {}
+        self.closed = False
+
+        # Channels being moved, (channel name, shard) -> future for the new shard's JOIN going through
+        self._joins = {}
+        self._moving = {}
+        self._move_tasks = set()
+
+    @property
+    def channels(self):
+        return self.assignments.keys()
+
+    @property
+    def metrics(self):
+        return SocketMetrics.merged([shard.metrics for shard in self.shards])
+
+    def _pick_shard(self):
+        candidates = [shard for shard in self.shards if len(shard.channels) < self.max_channels_per_shard]
+        if not candidates:
+            raise ValueError(f'All {len(self.shards)} shards are full ({self.max_channels_per_shard} channels each)')
+
+        # Prefer shards that are up, so the channel gets joined right away
+        return min(candidates, key=lambda shard: (not shard.connected, len(shard.channels), shard.index))
+
+    def assign_channel(self, channel_name):
+        # Picks a shard for the channel, returns None if it already had one
+        if channel_name in self.assignments:
+            return None
+
+        shard = self._pick_shard()
+        shard.channels.add(channel_name)
+        self.assignments[channel_name] = shard
+        irc_log.debug(f'Assigned #{channel_name} to shard {shard.index}')
+
+        return shard
 
     async def join_channel(self, channel_name):
-        await self.send(f'JOIN #{channel_name}')
+        shard = self.assign_channel(channel_name)
+
+        if shard is not None and shard.connected:
+            await shard.join_channel(channel_name)
+
+    async def part_channel(self, channel_name):
+        shard = self.assignments.pop(channel_name, None)
+        if shard is None:
+            return
+
+        shard.channels.discard(channel_name)
+
+        if shard.connected:
+            await shard.part_channel(channel_name)
+
+    async def on_shard_connect(self, shard):
+        setup = [shard.login(self.user_name, self.oauth_token)]
+
+        if self.capabilities:
+            setup.append(shard.request_capabilities(*self.capabilities))
+
+        await asyncio.gather(*setup)
+
+        # Not waiting for these, with a lot of channels the JOIN budget would keep the shard from reading for a while
+        for channel_name in shard.channels:
+            shard.join_channel(channel_name)
+
+        self._rebalance()
+
+    async def on_shard_disconnect(self, shard):
+        pass
+
+    def _rebalance(self):
+        # Channels that were added while a shard was down ended up on the others, even them out again.
+        # Only connected shards take part, a shard that is down keeps its channels until it comes back.
+        connected = [shard for shard in self.shards if shard.connected]
+        if len(connected) < 2:
+            return
+
+        target = -(-sum(len(shard.channels) for shard in connected) // len(connected))
+
+        for shard in connected:
+            while len(shard.channels) < target:
+                donor = max(connected, key=lambda s: len(s.channels))
+                if len(donor.channels) <= len(shard.channels) + 1:
+                    break
+
+                channel_name = next(iter(donor.channels))
+                self._move(channel_name, donor, shard)
+
+    def _move(self, channel_name, old, new):
+        irc_log.debug(f'Moving #{channel_name} from shard {old.index} to shard {new.index}')
+
+        old.channels.discard(channel_name)
+        new.channels.add(channel_name)
+        self.assignments[channel_name] = new
+
+        task = asyncio.create_task(self._finish_move(channel_name, old, new))
+        self._move_tasks.add(task)
+        task.add_done_callback(self._move_tasks.discard)
+
+    async def _finish_move(self, channel_name, old, new):
+        # Join first so nothing is missed. Until Twitch confirms the JOIN, which can take a while when the JOIN
+        # budget is used up, lines from both shards are passed on, the same line may come through twice then.
+        joined = self._joins[channel_name, new] = asyncio.get_running_loop().create_future()
+        self._moving[channel_name] = old
+
+        try:
+            new.join_channel(channel_name)
+            await asyncio.wait_for(joined, MOVE_JOIN_TIMEOUT)
+
+        except asyncio.TimeoutError:
+            irc_log.warning(f'Shard {new.index} has not joined #{channel_name} after {MOVE_JOIN_TIMEOUT}s, parting shard {old.index} anyway')
+
+        finally:
+            self._joins.pop((channel_name, new), None)
+            if self._moving.get(channel_name) is old:
+                del self._moving[channel_name]
+
+            if old.connected and channel_name not in old.channels:
+                old.part_channel(channel_name)
+
+    async def on_shard_message(self, shard, msg):
+        if msg.command == 'JOIN':
+            joined = self._joins.get((msg.params[0][1:], shard))
+
+            if joined is not None and not joined.done() and msg.name == self.user_name.lower():
+                joined.set_result(None)
+
+            return
+
+        if msg.command != 'PRIVMSG':
+            return
+
+        channel_name = msg.params[0][1:]
+
+        if self.assignments.get(channel_name) is shard or self._moving.get(channel_name) is shard:
+            await self.on_channel_message(channel_name, msg)
+
+    async def on_channel_message(self, channel_name, msg):
+        pass
+
+    async def connect(self):
+        await asyncio.gather(*(shard.connect() for shard in self.shards))
+
+    async def close(self):
+        self.closed = True
+
+        for task in self._move_tasks:
+            task.cancel()
+
+        await asyncio.gather(*(shard.close() for shard in self.shards))
+
+
+# PubSub message decoding
+
+PubSubEnvelope = namedtuple('PubSubEnvelope', 'type topic message nonce error')
+
+def decode_pubsub_envelope(raw):
+    # The message in a MESSAGE envelope is JSON inside a string, it's left as is until someone wants it
+    data = json_loads(raw)
+    inner = data.get('data') or {}
+    return PubSubEnvelope(data.get('type'), inner.get('topic'), inner.get('message'), data.get('nonce'), data.get('error'))
 
 
 class TwitchPubSubSocket:
-    def __init__(self):
-        self._session = None
+    # Topic prefix (the part before the first dot) -> function turning the raw message into whatever on_message gets.
+    # Messages on other topics are handed over as Obj, or dropped without decoding if decode_unknown_topics is off.
+    topic_decoders = {}
+    decode_unknown_topics = True
+
+    def __init__(self, ping_interval=180, ping_offset=0, response_timeout=10, url=PUBSUB_URL, session=None):
+        self.url = url
+        self._session = session
+        self._owns_session = session is None
         self._ws = None
         self.closed = False
         self._last_pong = 0
+        self._last_ping = 0
+
+        # Sockets sharing a pool start pinging at different times, so they don't all go quiet at once
+        self.ping_interval = ping_interval
+        self.ping_offset = ping_offset
+
+        # LISTEN/UNLISTEN nonce -> future resolved by the matching RESPONSE
+        self.response_timeout = response_timeout
+        self._responses = {}
+
+        self.metrics = SocketMetrics()
+        self._counters = self.metrics.counters
+        self._message_rate = self.metrics.rate('messages')
+        self._parse_time = self.metrics.histogram('parse_time')
+        self._handler_time = self.metrics.histogram('handler_time')
+        self._ping_rtt = self.metrics.histogram('ping_rtt')
     
     async def send(self, o):
         pubsub_log.debug(f'> {o}')
         await self._ws.send_json(o)
 
+    async def request(self, type, data):
+        # Sends a message that Twitch answers with a RESPONSE, and raises PubSubError if that has an error in it
+        nonce = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._responses[nonce] = future
+
+        try:
+            await self.send({
+                'type': type,
+                'nonce': nonce,
+                'data': data,
+            })
+
+            await asyncio.wait_for(future, self.response_timeout)
+
+        except asyncio.TimeoutError:
+            raise PubSubError(f'No response to {type}') from None
+
+        finally:
+            self._responses.pop(nonce, None)
+
+    def _fail_responses(self, exc):
+        for future in self._responses.values():
+            if not future.done():
+                future.set_exception(exc)
+
+        self._responses.clear()
+
     async def ping(self):
+        await asyncio.sleep(self.ping_offset)
+
         while not self.closed:
-            ping_sent_time = time.monotonic()
+            ping_sent_time = self._last_ping = time.monotonic()
             await self.send({
                 'type': 'PING'
             })
@@ -204,22 +953,50 @@ class TwitchPubSubSocket:
                 pubsub_log.warning('No pong, resetting')
                 await self._ws.close()
 
-            await asyncio.sleep(180)
+            await asyncio.sleep(self.ping_interval)
 
     async def _on_message(self, msg):
         pubsub_log.debug(f'< {msg}')
         
         if msg.type == 'PONG':
             self._last_pong = time.monotonic()
+
+            if self._last_ping:
+                self._ping_rtt.record(self._last_pong - self._last_ping)
         
         elif msg.type == 'RECONNECT':
             await self._ws.close()
 
         elif msg.type == 'MESSAGE':
-            await self.on_message(msg.data.topic, json.loads(msg.data.message, object_hook=Obj))
+            self._counters['messages'] += 1
+            self._message_rate.add()
+            decoder = self.topic_decoders.get(msg.topic.partition('.')[0])
+            start = time.perf_counter()
+
+            if decoder is not None:
+                message = decoder(msg.message)
+            elif self.decode_unknown_topics:
+                message = json.loads(msg.message, object_hook=Obj)
+            else:
+                self._counters['skipped'] += 1
+                return
+
+            decoded = time.perf_counter()
+            self._parse_time.record(decoded - start)
+
+            if message is not None:
+                await self.on_message(msg.topic, message)
+                self._handler_time.record(time.perf_counter() - decoded)
 
         elif msg.type == 'RESPONSE':
-            pubsub_log.debug(msg)
+            future = self._responses.get(msg.nonce)
+
+            if future is None or future.done():
+                pubsub_log.debug(f'Unexpected response {msg}')
+            elif msg.error:
+                future.set_exception(PubSubError(msg.error))
+            else:
+                future.set_result(None)
 
         else:
             pubsub_log.warning(f'Unknown message type {msg}')
@@ -227,21 +1004,28 @@ class TwitchPubSubSocket:
     async def on_message(self, topic, message):
         pass
 
+    # Responses are only read once this returns, so it must not wait for any
     async def on_connect(self):
         pass
 
+    async def on_disconnect(self):
+        pass
+
     async def ensure_session(self):
         if not self._session:
             self._session = aiohttp.ClientSession()
+            self._owns_session = True
 
     async def connect(self):
         backoff = ExponentialBackoff()
-        ping_task = None
         
         while not self.closed:
+            ping_task = None
+
             try:
                 await self.ensure_session()
-                self._ws = await self._session.ws_connect('wss://pubsub-edge.twitch.tv')
+                self._ws = await self._session.ws_connect(self.url)
+                self._counters['connects'] += 1
 
                 await self.on_connect()
 
@@ -249,33 +1033,279 @@ class TwitchPubSubSocket:
                 
                 async for msg in self._ws:
                     if msg.type == aiohttp.WSMsgType.TEXT:
-                        data = json.loads(msg.data, object_hook=Obj)
-                        await self._on_message(data)
+                        await self._on_message(decode_pubsub_envelope(msg.data))
                     
                     elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
                         raise WebSocketError
 
             except (OSError, aiohttp.ClientError, asyncio.TimeoutError, WebSocketError):
-                pubsub_log.error(exc_info=True)
-                ping_task.cancel()
+                pubsub_log.error('PubSub connection failed', exc_info=True)
+                self._counters['connection_errors'] += 1
+                delay = backoff.delay()
+
+            else:
+                # Closed by the server, or by us after a RECONNECT, either way it's fine to come right back
+                delay = 0
+
+            finally:
+                if ping_task is not None:
+                    ping_task.cancel()
+
+                self._fail_responses(WebSocketError('Connection lost'))
+
+            await self.on_disconnect()
                 
-                if self.closed:
-                    return
+            if self.closed:
+                return
 
-                pubsub_log.info('Reconnecting to PubSub')
-                await asyncio.sleep(backoff.delay())
+            pubsub_log.info('Reconnecting to PubSub')
+            self._record_reconnect(delay)
+            await asyncio.sleep(delay)
+
+    def _record_reconnect(self, delay):
+        self._counters['reconnects'] += 1
+        self._counters['backoff_seconds'] += delay
+        self.metrics.histogram('backoff', BACKOFF_BUCKETS).record(delay)
     
-    def close(self):
+    async def close(self):
         self.closed = True
 
-        asyncio.create_task(self._ws.close())
-        asyncio.create_task(self._session.close())
+        if self._ws:
+            await self._ws.close()
+        if self._session and self._owns_session:
+            await self._session.close()
 
     async def listen_to(self, token, *topics):
-        await self.send({
-            'type': 'LISTEN',
-            'data': {
-                'topics': topics,
-                'auth_token': token
-            }
+        await self.request('LISTEN', {
+            'topics': topics,
+            'auth_token': token
+        })
+
+    async def unlisten_from(self, token, *topics):
+        await self.request('UNLISTEN', {
+            'topics': topics,
+            'auth_token': token
         })
+
+
+class TwitchPubSubShard(TwitchPubSubSocket):
+    def __init__(self, pool, index, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.pool = pool
+        self.index = index
+        self.topic_decoders = pool.topic_decoders
+        self.decode_unknown_topics = pool.decode_unknown_topics
+
+        # Topic -> auth token it was LISTENed with
+        self.topics = {}
+        self.connected = False
+        self.listen_task = None
+
+    async def on_connect(self):
+        self.connected = True
+        await self.pool.on_shard_connect(self)
+
+    async def on_disconnect(self):
+        self.connected = False
+        await self.pool.on_shard_disconnect(self)
+
+    async def on_message(self, topic, message):
+        await self.pool.on_shard_message(self, topic, message)
+
+
+class TwitchPubSubPool:
+    # Spreads topics over several PubSub connections, Twitch only allows 50 per connection.
+    # Shards are opened as they're needed, each one reconnects and re-LISTENs on its own.
+
+    topic_decoders = {}
+    decode_unknown_topics = True
+
+    def __init__(self, oauth_token, max_topics_per_shard=50, max_shards=10, ping_interval=180, **socket_kwargs):
+        self.oauth_token = oauth_token
+        self.max_topics_per_shard = max_topics_per_shard
+        self.max_shards = max_shards
+        self.ping_interval = ping_interval
+        self.socket_kwargs = socket_kwargs
+
+        self.shards = []
+        self.assignments = {}
+        self.running = False
+        self.closed = False
+        self._shard_tasks = []
+        self._closed = asyncio.Event()
+
+        # Topic -> future for the first response to its LISTEN, for topics on shards that weren't connected yet
+        self._first_listens = {}
+
+    @property
+    def topics(self):
+        return self.assignments.keys()
+
+    @property
+    def metrics(self):
+        return SocketMetrics.merged([shard.metrics for shard in self.shards])
+
+    def _add_shard(self):
+        index = len(self.shards)
+
+        # Evenly spaced over the ping interval, for as many shards as there could ever be
+        shard = TwitchPubSubShard(
+            self, index,
+            ping_interval=self.ping_interval,
+            ping_offset=index * self.ping_interval / self.max_shards,
+            **self.socket_kwargs,
+        )
+        self.shards.append(shard)
+        pubsub_log.debug(f'Opened shard {index}')
+
+        if self.running:
+            self._shard_tasks.append(asyncio.create_task(shard.connect()))
+
+        return shard
+
+    def _pick_shard(self):
+        # Fill up the shards we have before opening another connection
+        for shard in self.shards:
+            if len(shard.topics) < self.max_topics_per_shard:
+                return shard
+
+        if len(self.shards) >= self.max_shards:
+            raise ValueError(f'All {self.max_shards} shards are full ({self.max_topics_per_shard} topics each)')
+
+        return self._add_shard()
+
+    async def listen(self, *topics, token=None):
+        # Raises PubSubError if Twitch rejects the LISTEN, the topics are dropped again in that case.
+        # Topics on shards that aren't connected yet are LISTENed to once they are, and waited for until then.
+        token = token or self.oauth_token
+        new_topics = {}
+        loop = asyncio.get_running_loop()
+
+        for topic in topics:
+            if topic in self.assignments:
+                continue
+
+            shard = self._pick_shard()
+            shard.topics[topic] = token
+            self.assignments[topic] = shard
+            new_topics.setdefault(shard, []).append(topic)
+
+        listening = [(shard, shard_topics) for shard, shard_topics in new_topics.items() if shard.connected]
+        waiting = [topic for shard, shard_topics in new_topics.items() if not shard.connected for topic in shard_topics]
+
+        for topic in waiting:
+            self._first_listens[topic] = loop.create_future()
+
+        results = await asyncio.gather(
+            *(shard.listen_to(token, *shard_topics) for shard, shard_topics in listening),
+            *(self._first_listens[topic] for topic in waiting),
+            return_exceptions=True,
+        )
+
+        error = None
+        for (shard, shard_topics), result in zip(listening, results):
+            if isinstance(result, Exception):
+                self._drop_topics(shard, shard_topics)
+                error = error or result
+
+        # Those were dropped by _relisten already
+        for result in results[len(listening):]:
+            if isinstance(result, Exception):
+                error = error or result
+
+        if error is not None:
+            raise error
+
+    def _drop_topics(self, shard, topics):
+        for topic in topics:
+            shard.topics.pop(topic, None)
+            self.assignments.pop(topic, None)
+
+    async def unlisten(self, *topics):
+        by_shard = {}
+
+        for topic in topics:
+            shard = self.assignments.pop(topic, None)
+            if shard is None:
+                continue
+
+            if (first_listen := self._first_listens.pop(topic, None)) is not None:
+                first_listen.cancel()
+
+            token = shard.topics.pop(topic)
+            by_shard.setdefault((shard, token), []).append(topic)
+
+        await asyncio.gather(*(
+            shard.unlisten_from(token, *shard_topics)
+            for (shard, token), shard_topics in by_shard.items()
+            if shard.connected
+        ))
+
+    async def on_shard_connect(self, shard):
+        # Only this shard's topics need to be LISTENed to again, the others never noticed anything.
+        # Can't wait for the responses in here, they're read once we return.
+        shard.listen_task = asyncio.create_task(self._relisten(shard))
+
+    async def _relisten(self, shard):
+        by_token = {}
+        for topic, token in shard.topics.items():
+            by_token.setdefault(token, []).append(topic)
+
+        results = await asyncio.gather(
+            *(shard.listen_to(token, *topics) for token, topics in by_token.items()),
+            return_exceptions=True,
+        )
+
+        for topics, result in zip(by_token.values(), results):
+            if isinstance(result, Exception):
+                # Dropped like a rejected listen(), trying again on every reconnect won't change Twitch's mind
+                pubsub_log.error(f'Shard {shard.index} could not LISTEN to {", ".join(topics)}, dropping them: {result!r}')
+                self._drop_topics(shard, topics)
+
+            for topic in topics:
+                first_listen = self._first_listens.pop(topic, None)
+
+                if first_listen is None or first_listen.done():
+                    continue
+
+                if isinstance(result, Exception):
+                    first_listen.set_exception(result)
+                else:
+                    first_listen.set_result(None)
+
+    async def on_shard_disconnect(self, shard):
+        if shard.listen_task is not None:
+            shard.listen_task.cancel()
+            shard.listen_task = None
+
+    async def on_shard_message(self, shard, topic, message):
+        await self.on_message(topic, message)
+
+    async def on_message(self, topic, message):
+        pass
+
+    async def connect(self):
+        self.running = True
+
+        for shard in self.shards:
+            self._shard_tasks.append(asyncio.create_task(shard.connect()))
+
+        # More shards can open while we're running, so wait for close instead of the shards themselves
+        await self._closed.wait()
+
+    async def close(self):
+        self.closed = True
+        self.running = False
+        self._closed.set()
+
+        for shard in self.shards:
+            if shard.listen_task is not None:
+                shard.listen_task.cancel()
+
+        for first_listen in self._first_listens.values():
+            first_listen.cancel()
+
+        self._first_listens = {}
+
+        await asyncio.gather(*(shard.close() for shard in self.shards))